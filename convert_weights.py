@@ -0,0 +1,39 @@
+from stable_diffusion_tf.stable_diffusion import StableDiffusion
+from stable_diffusion_tf.weights import save_native_weights
+import argparse
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "--output",
+    type=str,
+    required=True,
+    help="directory to write the native weight files to",
+)
+
+parser.add_argument(
+    "--ckpt",
+    type=str,
+    help="convert a PyTorch .ckpt instead of the default Keras weights",
+)
+
+parser.add_argument(
+    "--fp16",
+    default=False,
+    action="store_true",
+    help="store weights as float16 on disk (half the size)",
+)
+
+args = parser.parse_args()
+
+# Weights do not depend on the resolution, so the smallest graphs will do
+generator = StableDiffusion(img_height=64, img_width=64, download_weights=args.ckpt is None)
+if args.ckpt is not None:
+    generator.load_weights_from_pytorch_ckpt(args.ckpt)
+
+save_native_weights(
+    [generator.text_encoder, generator.diffusion_model, generator.decoder, generator.encoder],
+    args.output,
+    dtype="float16" if args.fp16 else None,
+)
+print(f"saved at {args.output}")
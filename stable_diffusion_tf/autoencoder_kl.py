@@ -1,18 +1,22 @@
 import tensorflow as tf
 from tensorflow import keras
-import tensorflow_addons as tfa
 
-from .layers import apply_seq, PaddedConv2D
+from .layers import apply_seq, GroupNormalization, PaddedConv2D, chunked_attention
+
+VAE_ATTENTION_MEMORY_BUDGET = 256 * 2**20
 
 
 class AttentionBlock(keras.layers.Layer):
     def __init__(self, channels):
         super().__init__()
-        self.norm = tfa.layers.GroupNormalization(epsilon=1e-5)
+        self.norm = GroupNormalization(epsilon=1e-5)
         self.q = PaddedConv2D(channels, 1)
         self.k = PaddedConv2D(channels, 1)
         self.v = PaddedConv2D(channels, 1)
         self.proj_out = PaddedConv2D(channels, 1)
+        # Per-sample bytes allowed for attention scores (None: no chunking).
+        # Small latents fit and still take a single chunk.
+        self.memory_budget = VAE_ATTENTION_MEMORY_BUDGET
 
     def call(self, x):
         h_ = self.norm(x)
@@ -20,6 +24,14 @@ class AttentionBlock(keras.layers.Layer):
 
         # Compute attention
         b, h, w, c = q.shape
+        if self.memory_budget is not None:
+            q = tf.reshape(q, (-1, 1, h * w, c))  # b,1,hw,c
+            k = tf.reshape(k, (-1, 1, h * w, c))
+            v = tf.reshape(v, (-1, 1, h * w, c))
+            h_ = chunked_attention(q, k, v, c ** (-0.5), self.memory_budget)
+            h_ = tf.reshape(h_, (-1, h, w, c))
+            return x + self.proj_out(h_)
+
         q = tf.reshape(q, (-1, h * w, c))  # b,hw,c
         k = keras.layers.Permute((3, 1, 2))(k)
         k = tf.reshape(k, (-1, c, h * w))  # b,c,hw
@@ -40,9 +52,9 @@ class AttentionBlock(keras.layers.Layer):
 class ResnetBlock(keras.layers.Layer):
     def __init__(self, in_channels, out_channels):
         super().__init__()
-        self.norm1 = tfa.layers.GroupNormalization(epsilon=1e-5)
+        self.norm1 = GroupNormalization(epsilon=1e-5)
         self.conv1 = PaddedConv2D(out_channels, 3, padding=1)
-        self.norm2 = tfa.layers.GroupNormalization(epsilon=1e-5)
+        self.norm2 = GroupNormalization(epsilon=1e-5)
         self.conv2 = PaddedConv2D(out_channels, 3, padding=1)
         self.nin_shortcut = (
             PaddedConv2D(out_channels, 1)
@@ -57,9 +69,10 @@ class ResnetBlock(keras.layers.Layer):
 
 
 class Decoder(keras.Sequential):
-    def __init__(self):
+    # Passing the `layers` of an existing Decoder shares its weights
+    def __init__(self, layers=None):
         super().__init__(
-            [
+            layers or [
                 keras.layers.Lambda(lambda x: 1 / 0.18215 * x),
                 PaddedConv2D(4, 1),
                 PaddedConv2D(512, 3, padding=1),
@@ -84,7 +97,7 @@ class Decoder(keras.Sequential):
                 ResnetBlock(256, 128),
                 ResnetBlock(128, 128),
                 ResnetBlock(128, 128),
-                tfa.layers.GroupNormalization(epsilon=1e-5),
+                GroupNormalization(epsilon=1e-5),
                 keras.layers.Activation("swish"),
                 PaddedConv2D(3, 3, padding=1),
             ]
@@ -92,9 +105,9 @@ class Decoder(keras.Sequential):
 
 
 class Encoder(keras.Sequential):
-    def __init__(self):
+    def __init__(self, layers=None):
         super().__init__(
-            [
+            layers or [
                 PaddedConv2D(128, 3, padding=1 ),
                 ResnetBlock(128,128),
                 ResnetBlock(128, 128),
@@ -115,7 +128,7 @@ class Encoder(keras.Sequential):
                 AttentionBlock(512),
                 ResnetBlock(512, 512),
                 
-                tfa.layers.GroupNormalization(epsilon=1e-5) , 
+                GroupNormalization(epsilon=1e-5) , 
                 keras.layers.Activation("swish"),
                 PaddedConv2D(8, 3, padding=1 ),
                 PaddedConv2D(8, 1 ),
@@ -0,0 +1,303 @@
+import copy
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+import tensorflow as tf
+
+from .cancellation import GenerationCancelled, GenerationResult
+from .constants import _UNCONDITIONAL_TOKENS
+from .schedulers import get_scheduler
+
+
+class _Request:
+    def __init__(
+        self,
+        prompt,
+        negative_prompt,
+        num_steps,
+        unconditional_guidance_scale,
+        seed,
+        scheduler,
+        cancel_token=None,
+    ):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.num_steps = num_steps
+        self.unconditional_guidance_scale = unconditional_guidance_scale
+        self.seed = seed
+        self.scheduler = scheduler
+        self.cancel_token = cancel_token
+        self.future = Future()
+
+    @property
+    def key(self):
+        # Requests can share a generate call when they run the same schedule.
+        # Scheduler instances hold per-call state, so they are never shared.
+        scheduler = self.scheduler if isinstance(self.scheduler, str) else id(self.scheduler)
+        return (self.num_steps, scheduler)
+
+
+class _Engine:
+    def __init__(self, generator, max_batch_size):
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt,
+        negative_prompt=None,
+        num_steps=25,
+        unconditional_guidance_scale=7.5,
+        seed=None,
+        scheduler="ddim",
+        cancel_token=None,
+    ):
+        if self._closed:
+            raise RuntimeError("%s is closed" % type(self).__name__)
+        if seed is None:
+            seed = int(np.random.randint(0, 2**31 - 1))
+        request = _Request(
+            prompt,
+            negative_prompt,
+            num_steps,
+            unconditional_guidance_scale,
+            seed,
+            scheduler,
+            cancel_token=cancel_token,
+        )
+        self._queue.put(request)
+        return request.future
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        raise NotImplementedError
+
+
+class BatchingEngine(_Engine):
+    """Coalesces concurrent single-image requests into batched `generate` calls.
+
+    A worker thread takes the oldest queued request and waits up to
+    `max_wait` seconds for compatible ones (same steps and scheduler) until
+    the batch holds `max_batch_size` requests. Each request's future
+    resolves with its own (height, width, 3) uint8 image.
+    """
+
+    def __init__(self, generator, max_batch_size=4, max_wait=0.05):
+        self.max_wait = max_wait
+        self._pending = deque()
+        super().__init__(generator, max_batch_size)
+
+    def _next_request(self, timeout=None):
+        if self._pending:
+            return self._pending.popleft()
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self, first):
+        batch = [first]
+        skipped = []
+        wait_until = time.monotonic() + self.max_wait
+        # Compatible requests that are already waiting join right away
+        for request in list(self._pending):
+            if len(batch) >= self.max_batch_size:
+                break
+            if request.key == first.key:
+                self._pending.remove(request)
+                batch.append(request)
+        while len(batch) < self.max_batch_size:
+            remaining = wait_until - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            if request.key == first.key:
+                batch.append(request)
+            else:
+                skipped.append(request)
+        self._pending.extend(skipped)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._next_request()
+            if first is None:
+                break
+            batch = self._collect(first)
+            for request in batch:
+                if request.cancel_token is not None and request.cancel_token.cancelled:
+                    request.future.cancel()
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            if batch:
+                self._run_batch(batch)
+
+        for request in self._pending:
+            request.future.cancel()
+
+    def _run_batch(self, batch):
+        try:
+            images = self.generator.generate(
+                [r.prompt for r in batch],
+                negative_prompt=[r.negative_prompt for r in batch],
+                num_steps=batch[0].num_steps,
+                unconditional_guidance_scale=[r.unconditional_guidance_scale for r in batch],
+                seeds=[r.seed for r in batch],
+                scheduler=batch[0].scheduler,
+            )
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        for request, image in zip(batch, images):
+            request.future.set_result(image)
+
+
+class _Sequence:
+    # Per-request sampling state of the continuous batching engine
+    def __init__(self, request, scheduler, latent, context, unconditional_context):
+        self.request = request
+        self.scheduler = scheduler
+        self.latent = latent
+        self.context = context
+        self.unconditional_context = unconditional_context
+        self.index = len(scheduler.timesteps) - 1
+
+    @property
+    def timestep(self):
+        return self.scheduler.timesteps[self.index]
+
+
+class ContinuousBatchingEngine(_Engine):
+    """Batches denoising steps, rather than whole requests, across requests.
+
+    Every in-flight request keeps its own latent, scheduler and context, so
+    requests with different prompts, step counts or schedulers share each
+    UNet call with per-sample timestep embeddings. New requests join the
+    running batch between steps and finished ones leave it straight away,
+    so nobody waits for a batch that started before they arrived.
+    """
+
+    def __init__(self, generator, max_batch_size=8):
+        super().__init__(generator, max_batch_size)
+
+    def _start(self, request):
+        generator = self.generator
+        # Scheduler instances keep timesteps and multistep history, so each
+        # sequence works on its own copy of one shared between requests
+        scheduler = copy.deepcopy(get_scheduler(request.scheduler))
+        scheduler.set_timesteps(request.num_steps)
+        tokens = np.array([generator.tokenize(request.prompt)]).astype("int32")
+        if request.negative_prompt is None:
+            unconditional_tokens = np.array([_UNCONDITIONAL_TOKENS]).astype("int32")
+        else:
+            unconditional_tokens = np.array(
+                [generator.tokenize(request.negative_prompt, "Negative prompt")]
+            ).astype("int32")
+        return _Sequence(
+            request,
+            scheduler,
+            generator.get_starting_latent(scheduler, [request.seed]),
+            generator.encode_text(tokens),
+            generator.encode_text(unconditional_tokens),
+        )
+
+    def _admit(self, active):
+        # Blocks only when nothing is running; returns False on close
+        while len(active) < self.max_batch_size:
+            try:
+                request = self._queue.get(block=not active)
+            except queue.Empty:
+                return True
+            if request is None:
+                return False
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            try:
+                active.append(self._start(request))
+            except Exception as e:
+                request.future.set_exception(e)
+        return True
+
+    def _run(self):
+        active = []
+        running = True
+        while running or active:
+            if running:
+                running = self._admit(active)
+            active = self._drop_cancelled(active)
+            if not active:
+                continue
+            try:
+                self._step(active)
+            except Exception as e:
+                for sequence in active:
+                    sequence.request.future.set_exception(e)
+                active = []
+                continue
+
+            finished = [s for s in active if s.index < 0]
+            active = [s for s in active if s.index >= 0]
+            if finished:
+                self._finish(finished)
+
+    def _drop_cancelled(self, active):
+        remaining = []
+        for sequence in active:
+            token = sequence.request.cancel_token
+            if token is not None and token.cancelled:
+                num_steps = len(sequence.scheduler.timesteps)
+                result = GenerationResult(
+                    None,
+                    GenerationResult.CANCELLED,
+                    num_steps - 1 - sequence.index,
+                    num_steps,
+                )
+                sequence.request.future.set_exception(GenerationCancelled(result))
+            else:
+                remaining.append(sequence)
+        return remaining
+
+    def _step(self, active):
+        e_t = self.generator.get_model_output(
+            tf.concat([s.latent for s in active], axis=0),
+            [s.timestep for s in active],
+            np.concatenate([s.context for s in active], axis=0),
+            np.concatenate([s.unconditional_context for s in active], axis=0),
+            np.array(
+                [s.request.unconditional_guidance_scale for s in active], dtype="float32"
+            ).reshape(-1, 1, 1, 1),
+            len(active),
+        )
+        for i, sequence in enumerate(active):
+            latent = sequence.latent
+            sequence.latent, _ = sequence.scheduler.step(
+                latent, tf.cast(e_t[i : i + 1], latent.dtype), sequence.index
+            )
+            sequence.index -= 1
+
+    def _finish(self, finished):
+        try:
+            images = self.generator.decode_latent(
+                tf.concat([s.latent for s in finished], axis=0)
+            )
+        except Exception as e:
+            for sequence in finished:
+                sequence.request.future.set_exception(e)
+            return
+        for sequence, image in zip(finished, images):
+            sequence.request.future.set_result(image)
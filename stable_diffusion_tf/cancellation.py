@@ -0,0 +1,48 @@
+import threading
+import time
+from collections import namedtuple
+
+
+class CancellationToken:
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+class GenerationResult(
+    namedtuple("GenerationResult", ["images", "status", "steps_completed", "num_steps"])
+):
+    COMPLETED = "completed"
+    CANCELLED = "cancelled"
+    # The deadline passed between steps and the call stopped without images
+    DEADLINE_ABORTED = "deadline_aborted"
+    # The deadline passed and the last clean-image estimate was decoded instead
+    DEADLINE_DECODED = "deadline_decoded"
+
+    @property
+    def aborted(self):
+        return self.images is None
+
+
+class GenerationCancelled(Exception):
+    def __init__(self, result):
+        super().__init__(
+            "Generation stopped after %d of %d steps (%s)"
+            % (result.steps_completed, result.num_steps, result.status)
+        )
+        self.result = result
+
+
+def check_interrupt(cancel_token=None, deadline=None):
+    # `deadline` is an absolute time.time() timestamp
+    if cancel_token is not None and cancel_token.cancelled:
+        return GenerationResult.CANCELLED
+    if deadline is not None and time.time() >= deadline:
+        return GenerationResult.DEADLINE_ABORTED
+    return None
@@ -0,0 +1,135 @@
+import pickle
+import struct
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+# PyTorch storage classes and the numpy dtypes of their data. bfloat16 has
+# no numpy dtype, it is read as uint16 and widened to float32 on access.
+_STORAGE_DTYPES = {
+    "DoubleStorage": np.float64,
+    "FloatStorage": np.float32,
+    "HalfStorage": np.float16,
+    "BFloat16Storage": np.uint16,
+    "LongStorage": np.int64,
+    "IntStorage": np.int32,
+    "ShortStorage": np.int16,
+    "CharStorage": np.int8,
+    "ByteStorage": np.uint8,
+    "BoolStorage": np.bool_,
+}
+
+# Size of a zip local file header before the file name and extra field
+_LOCAL_HEADER_SIZE = 30
+
+
+class _StorageType:
+    def __init__(self, name):
+        self.name = name
+
+
+class _Storage:
+    def __init__(self, data, bfloat16=False):
+        self.data = data
+        self.bfloat16 = bfloat16
+
+
+class Tensor:
+    """A read-only numpy view of a tensor stored in a checkpoint."""
+
+    def __init__(self, storage, offset, shape, stride):
+        data = storage.data
+        self.bfloat16 = storage.bfloat16
+        self.shape = tuple(shape)
+        self.view = np.lib.stride_tricks.as_strided(
+            data[offset:],
+            shape=self.shape,
+            strides=[s * data.itemsize for s in stride],
+            writeable=False,
+        )
+
+    def numpy(self):
+        if self.bfloat16:
+            return (self.view.astype(np.uint32) << 16).view(np.float32)
+        return self.view
+
+
+class _Placeholder:
+    # Stands in for classes of other libraries (training callbacks,
+    # hyperparameter containers, ...) that are stored next to the weights
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __setstate__(self, state):
+        pass
+
+
+def _rebuild_tensor(storage, offset, shape, stride, *args):
+    return Tensor(storage, offset, shape, stride)
+
+
+def _rebuild_parameter(tensor, *args):
+    return tensor
+
+
+class _Unpickler(pickle.Unpickler):
+    # Only rebuilds tensors and plain containers; nothing from the
+    # checkpoint is imported or executed
+    def __init__(self, file, load_storage):
+        super().__init__(file)
+        self._load_storage = load_storage
+
+    def find_class(self, module, name):
+        if module == "torch._utils" and name == "_rebuild_tensor_v2":
+            return _rebuild_tensor
+        if module == "torch._utils" and name == "_rebuild_parameter":
+            return _rebuild_parameter
+        if module == "collections" and name == "OrderedDict":
+            return OrderedDict
+        if module == "torch" and name in _STORAGE_DTYPES:
+            return _StorageType(name)
+        return type(name, (_Placeholder,), {"__module__": module})
+
+    def persistent_load(self, pid):
+        # ("storage", storage_type, key, location, numel)
+        _, storage_type, key, _, _ = pid
+        return self._load_storage(storage_type.name, key)
+
+
+def load_state_dict(path):
+    # Returns {name: Tensor} for a PyTorch (>= 1.6) zip checkpoint. Tensors
+    # are views into a memory map of the file, so nothing is read until used.
+    if not zipfile.is_zipfile(path):
+        raise ValueError(
+            "%s is not a zip checkpoint; legacy checkpoints have to be re-saved "
+            "with torch.save from PyTorch 1.6 or later" % path
+        )
+    mapped = np.memmap(path, dtype=np.uint8, mode="r")
+    storages = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        pickle_name = next(n for n in archive.namelist() if n.endswith("data.pkl"))
+        prefix = pickle_name[: -len("data.pkl")]
+
+        def load_storage(storage_name, key):
+            if key in storages:
+                return storages[key]
+            info = archive.getinfo(prefix + "data/" + key)
+            dtype = _STORAGE_DTYPES[storage_name]
+            if info.compress_type == zipfile.ZIP_STORED:
+                f.seek(info.header_offset)
+                header = f.read(_LOCAL_HEADER_SIZE)
+                name_length, extra_length = struct.unpack("<HH", header[26:30])
+                start = info.header_offset + _LOCAL_HEADER_SIZE + name_length + extra_length
+                data = mapped[start : start + info.file_size].view(dtype)
+            else:
+                data = np.frombuffer(archive.read(info), dtype=dtype)
+            storages[key] = _Storage(data, bfloat16=storage_name == "BFloat16Storage")
+            return storages[key]
+
+        with archive.open(pickle_name) as pickle_file:
+            checkpoint = _Unpickler(pickle_file, load_storage).load()
+
+    if isinstance(checkpoint, dict) and "state_dict" in checkpoint:
+        return checkpoint["state_dict"]
+    return checkpoint
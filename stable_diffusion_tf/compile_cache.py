@@ -0,0 +1,86 @@
+import os
+import re
+
+import tensorflow as tf
+
+# First TensorFlow release with a persistent XLA compilation cache
+_MIN_TF_VERSION = (2, 12)
+
+_CACHE_FLAG = re.compile(r"--tf_xla_persistent_cache_directory=(\S+)")
+
+# TensorFlow parses TF_XLA_FLAGS when it is imported (above), so later
+# changes to the variable do not reach XLA
+_XLA_FLAGS_AT_IMPORT = os.environ.get("TF_XLA_FLAGS", "")
+
+
+def _cache_directory(flags):
+    match = _CACHE_FLAG.search(flags)
+    return None if match is None else os.path.abspath(match.group(1))
+
+
+class CompilationCache:
+    """On-disk cache of XLA executables for `jit_compile=True` models.
+
+    XLA only reads its cache directory from TF_XLA_FLAGS when TensorFlow is
+    imported, so the process has to be started with
+    `TF_XLA_FLAGS=--tf_xla_persistent_cache_directory=<root>`; `enable`
+    checks that this happened and reports the cache as disabled otherwise.
+    XLA keys the executables by the compiled program and TensorFlow version,
+    so workers running different models or shapes can share `root`. The
+    cache needs a GPU: on CPU, XLA compilation fails while it is set.
+    """
+
+    def __init__(self, root):
+        self.directory = os.path.abspath(root)
+        os.makedirs(self.directory, exist_ok=True)
+        self.entries_at_start = self._count()
+        self.enabled = False
+
+    def _count(self):
+        return len(os.listdir(self.directory))
+
+    def enable(self):
+        version = tuple(int(v) for v in tf.__version__.split(".")[:2])
+        if version < _MIN_TF_VERSION:
+            print(
+                "TensorFlow %s has no persistent XLA cache, compiling without %s"
+                % (tf.__version__, self.directory)
+            )
+            return False
+        directory = _cache_directory(_XLA_FLAGS_AT_IMPORT)
+        if _cache_directory(os.environ.get("TF_XLA_FLAGS", "")) != directory:
+            print(
+                "TF_XLA_FLAGS was changed after TensorFlow was imported and has no "
+                "effect, compiling without %s" % self.directory
+            )
+            return False
+        if directory != self.directory:
+            print(
+                "XLA compilation cache disabled: start the process with "
+                "TF_XLA_FLAGS=--tf_xla_persistent_cache_directory=%s (set before "
+                "TensorFlow is imported)" % self.directory
+            )
+            return False
+        if not tf.config.list_physical_devices("GPU"):
+            raise RuntimeError(
+                "XLA's persistent compilation cache needs a GPU, XLA compilation on "
+                "CPU fails while --tf_xla_persistent_cache_directory is set"
+            )
+        self.enabled = True
+        print(
+            "XLA compilation cache %s: %d cached executables"
+            % (self.directory, self.entries_at_start)
+        )
+        return True
+
+    def stats(self):
+        # Executables written since startup are cache misses; the rest were
+        # there to be reused. Nothing is written while the cache is disabled.
+        entries = self._count()
+        return {
+            "directory": self.directory,
+            "enabled": self.enabled,
+            "cached_at_start": self.entries_at_start,
+            "misses": entries - self.entries_at_start if self.enabled else None,
+            "entries": entries,
+        }
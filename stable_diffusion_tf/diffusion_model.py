@@ -2,7 +2,8 @@ import tensorflow as tf
 from tensorflow import keras
 import tensorflow_addons as tfa
 
-from .layers import PaddedConv2D, apply_seq, td_dot, GEGLU
+from .layers import PaddedConv2D, apply_seq, td_dot, GEGLU, chunked_attention
+from .token_merging import bipartite_soft_matching, token_merge_ratio
 
 
 class ResBlock(keras.layers.Layer):
@@ -45,6 +46,8 @@ class CrossAttention(keras.layers.Layer):
         self.scale = d_head**-0.5
         self.num_heads = n_heads
         self.head_size = d_head
+        # Per-sample bytes allowed for attention scores (None: no chunking)
+        self.memory_budget = None
         self.to_out = [keras.layers.Dense(n_heads * d_head)]
 
     def call(self, inputs):
@@ -60,12 +63,16 @@ class CrossAttention(keras.layers.Layer):
         v = tf.reshape(v, (-1, context.shape[1], self.num_heads, self.head_size))
 
         q = keras.layers.Permute((2, 1, 3))(q)  # (bs, num_heads, time, head_size)
-        k = keras.layers.Permute((2, 3, 1))(k)  # (bs, num_heads, head_size, time)
         v = keras.layers.Permute((2, 1, 3))(v)  # (bs, num_heads, time, head_size)
 
-        score = td_dot(q, k) * self.scale
-        weights = keras.activations.softmax(score)  # (bs, num_heads, time, time)
-        attention = td_dot(weights, v)
+        if self.memory_budget is not None:
+            k = keras.layers.Permute((2, 1, 3))(k)  # (bs, num_heads, time, head_size)
+            attention = chunked_attention(q, k, v, self.scale, self.memory_budget)
+        else:
+            k = keras.layers.Permute((2, 3, 1))(k)  # (bs, num_heads, head_size, time)
+            score = td_dot(q, k) * self.scale
+            weights = keras.activations.softmax(score)  # (bs, num_heads, time, time)
+            attention = td_dot(weights, v)
         attention = keras.layers.Permute((2, 1, 3))(
             attention
         )  # (bs, time, num_heads, head_size)
@@ -76,6 +83,9 @@ class CrossAttention(keras.layers.Layer):
 class BasicTransformerBlock(keras.layers.Layer):
     def __init__(self, dim, n_heads, d_head):
         super().__init__()
+        self.dim = dim
+        # (ratio, max_downsample) set by set_token_merging, None disables ToMe
+        self.token_merging = None
         self.norm1 = keras.layers.LayerNormalization(epsilon=1e-5)
         self.attn1 = CrossAttention(n_heads, d_head)
 
@@ -86,9 +96,19 @@ class BasicTransformerBlock(keras.layers.Layer):
         self.geglu = GEGLU(dim * 4)
         self.dense = keras.layers.Dense(dim)
 
-    def call(self, inputs):
+    def call(self, inputs, hw=None, downsample=None):
+        # `downsample` is the latent size over the (h, w) = `hw` of x
         x, context = inputs
-        x = self.attn1([self.norm1(x)]) + x
+        h_ = self.norm1(x)
+        ratio = 0.0
+        if self.token_merging is not None and hw is not None and downsample is not None:
+            ratio = token_merge_ratio(self.token_merging, downsample)
+        if ratio > 0:
+            h, w = hw
+            merge, unmerge = bipartite_soft_matching(h_, h, w, int(h * w * ratio))
+            x = unmerge(self.attn1([merge(h_)])) + x
+        else:
+            x = self.attn1([h_]) + x
         x = self.attn2([self.norm2(x), context]) + x
         return self.dense(self.geglu(self.norm3(x))) + x
 
@@ -102,15 +122,16 @@ class SpatialTransformer(keras.layers.Layer):
         self.transformer_blocks = [BasicTransformerBlock(channels, n_heads, d_head)]
         self.proj_out = PaddedConv2D(channels, 1)
 
-    def call(self, inputs):
+    def call(self, inputs, latent_hw=None):
         x, context = inputs
         b, h, w, c = x.shape
+        downsample = None if latent_hw is None else latent_hw[0] // h
         x_in = x
         x = self.norm(x)
         x = self.proj_in(x)
         x = tf.reshape(x, (-1, h * w, c))
         for block in self.transformer_blocks:
-            x = block([x, context])
+            x = block([x, context], hw=(h, w), downsample=downsample)
         x = tf.reshape(x, (-1, h, w, c))
         return self.proj_out(x) + x_in
 
@@ -191,29 +212,86 @@ class UNetModel(keras.models.Model):
         ]
 
     def call(self, inputs):
+        output, _ = self.call_with_cache(inputs)
+        return output
+
+    def call_with_cache(self, inputs, cache_depth=None, cached_features=None):
+        # Returns (output, features) where `features` is the up path
+        # activation that meets the skip connection of input block
+        # `cache_depth`. Given `cached_features` from an earlier step, only the
+        # input blocks up to `cache_depth` and the output blocks after that
+        # point are computed; everything deeper is reused.
         x, t_emb, context = inputs
         emb = apply_seq(t_emb, self.time_embed)
+        latent_hw = tuple(x.shape[1:3])
 
         def apply(x, layer):
             if isinstance(layer, ResBlock):
                 x = layer([x, emb])
             elif isinstance(layer, SpatialTransformer):
-                x = layer([x, context])
+                x = layer([x, context], latent_hw=latent_hw)
             else:
                 x = layer(x)
             return x
 
+        input_blocks = self.input_blocks
+        output_blocks = self.output_blocks
+        branch = None
+        if cache_depth is not None:
+            branch = len(self.output_blocks) - 1 - cache_depth
+        if cached_features is not None:
+            input_blocks = self.input_blocks[: cache_depth + 1]
+            output_blocks = self.output_blocks[branch:]
+
         saved_inputs = []
-        for b in self.input_blocks:
+        for b in input_blocks:
             for layer in b:
                 x = apply(x, layer)
             saved_inputs.append(x)
 
-        for layer in self.middle_block:
-            x = apply(x, layer)
+        features = None
+        if cached_features is None:
+            for layer in self.middle_block:
+                x = apply(x, layer)
+        else:
+            x = features = cached_features
 
-        for b in self.output_blocks:
+        for i, b in enumerate(output_blocks):
+            if cached_features is None and i == branch:
+                features = x
             x = tf.concat([x, saved_inputs.pop()], axis=-1)
             for layer in b:
                 x = apply(x, layer)
-        return apply_seq(x, self.out)
+        return apply_seq(x, self.out), features
+
+
+class DeepCache:
+    """Per-generation cache of deep UNet features (DeepCache, Ma et al. 2023).
+
+    Every `interval`-th call runs the full UNet and stores the up path
+    features; the calls in between only run the shallow, high-resolution
+    blocks on top of the stored features. Separate `key`s keep independent
+    caches, e.g. for unbatched conditional and unconditional passes.
+    """
+
+    def __init__(self, full_fn, partial_fn, interval=3):
+        self.full_fn = full_fn
+        self.partial_fn = partial_fn
+        self.interval = interval
+        self._features = {}
+        self._calls = {}
+
+    def __call__(self, inputs, key=None):
+        inputs = [tf.convert_to_tensor(i) for i in inputs]
+        features = self._features.get(key)
+        calls = self._calls.get(key, 0)
+        if (
+            features is None
+            or features.shape[0] != inputs[0].shape[0]
+            or calls % self.interval == 0
+        ):
+            output, self._features[key] = self.full_fn(inputs)
+        else:
+            output = self.partial_fn(inputs, features)
+        self._calls[key] = calls + 1
+        return output.numpy()
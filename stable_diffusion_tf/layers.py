@@ -1,5 +1,9 @@
+import math
+import threading
+
 import tensorflow as tf
 from tensorflow import keras
+import tensorflow_addons as tfa
 
 
 class PaddedConv2D(keras.layers.Layer):
@@ -15,6 +19,64 @@ class PaddedConv2D(keras.layers.Layer):
         return self.conv2d(x)
 
 
+# Stats modes and recorded statistics are kept per thread and per layer, so
+# a tiled run does not leak them into concurrent calls of the same layers,
+# which are shared with the compiled and pooled models
+_group_norm_state = threading.local()
+
+
+def _group_norm_states():
+    if not hasattr(_group_norm_state, "layers"):
+        _group_norm_state.layers = {}
+    return _group_norm_state.layers
+
+
+class GroupNormalization(tfa.layers.GroupNormalization):
+    # `stats_mode` None normalises with the statistics of the input itself,
+    # "record" also keeps them in `recorded_stats`, and "fixed" normalises
+    # with `recorded_stats` instead, so that tiles of one image share them
+    @property
+    def stats_mode(self):
+        return _group_norm_states().get(id(self), (None, None))[0]
+
+    @property
+    def recorded_stats(self):
+        return _group_norm_states().get(id(self), (None, None))[1]
+
+    def call(self, inputs):
+        stats_mode = self.stats_mode
+        if stats_mode is None:
+            return super().call(inputs)
+
+        shape = tf.shape(inputs)
+        c = inputs.shape[-1]
+        x = tf.reshape(inputs, (shape[0], shape[1], shape[2], self.groups, c // self.groups))
+        x = tf.cast(x, "float32")
+        if stats_mode == "fixed":
+            mean, variance = self.recorded_stats
+        else:
+            mean, variance = tf.nn.moments(x, axes=[1, 2, 4], keepdims=True)
+            _group_norm_states()[id(self)] = (stats_mode, (mean, variance))
+        x = (x - mean) * tf.math.rsqrt(variance + self.epsilon)
+        x = tf.cast(tf.reshape(x, shape), inputs.dtype)
+        if self.scale:
+            x = x * tf.cast(self.gamma, x.dtype)
+        if self.center:
+            x = x + tf.cast(self.beta, x.dtype)
+        return x
+
+
+def set_group_norm_stats_mode(model, stats_mode):
+    # Only affects calls made from the current thread
+    states = _group_norm_states()
+    for module in model.submodules:
+        if isinstance(module, GroupNormalization):
+            if stats_mode is None:
+                states.pop(id(module), None)
+            else:
+                states[id(module)] = (stats_mode, module.recorded_stats)
+
+
 class GEGLU(keras.layers.Layer):
     def __init__(self, dim_out):
         super().__init__()
@@ -47,3 +109,94 @@ def td_dot(a, b):
     bb = tf.reshape(b, (-1, b.shape[2], b.shape[3]))
     cc = keras.backend.batch_dot(aa, bb)
     return tf.reshape(cc, (-1, a.shape[1], cc.shape[1], cc.shape[2]))
+
+
+def attention_chunk_sizes(q_len, k_len, num_heads, itemsize, memory_budget):
+    # Largest (query, key) chunks whose per-sample score block
+    # (num_heads, q_chunk, k_chunk) fits in `memory_budget` bytes
+    row_bytes = num_heads * itemsize
+    if q_len * k_len * row_bytes <= memory_budget:
+        return q_len, k_len
+    q_chunk = memory_budget // (k_len * row_bytes)
+    if q_chunk >= min(q_len, 256):
+        return min(q_len, q_chunk), k_len
+    side = max(1, int(math.sqrt(memory_budget // row_bytes)))
+    return min(q_len, side), min(k_len, side)
+
+
+def chunked_attention(q, k, v, scale, memory_budget):
+    # Exact softmax(q k^T * scale) v for q, k, v of shape (bs, heads, time, d),
+    # computed in query chunks and, when a chunk still does not fit, with an
+    # online softmax over key chunks. The chunks run one after another in
+    # while loops (parallel_iterations=1) rather than as independent ops the
+    # runtime may schedule together, so peak memory is one score block.
+    q_len, k_len = q.shape[2], k.shape[2]
+    q_chunk, k_chunk = attention_chunk_sizes(
+        q_len, k_len, q.shape[1], q.dtype.size, memory_budget
+    )
+    if q_chunk >= q_len and k_chunk >= k_len:
+        return _attention(q, k, v, scale)
+
+    if k_chunk >= k_len:
+        fn = lambda q_c: _attention(q_c, k, v, scale)
+    else:
+        k_chunks, v_chunks = _split_chunks(k, k_chunk), _split_chunks(v, k_chunk)
+        fn = lambda q_c: _online_softmax_attention(q_c, k_chunks, v_chunks, k_len, scale)
+    outputs = tf.map_fn(
+        fn, _split_chunks(q, q_chunk), parallel_iterations=1, fn_output_signature=q.dtype
+    )
+    return _merge_chunks(outputs, q_len)
+
+
+def _attention(q, k, v, scale):
+    score = tf.matmul(q, k, transpose_b=True) * scale
+    return tf.matmul(keras.activations.softmax(score), v)
+
+
+def _online_softmax_attention(q, k_chunks, v_chunks, k_len, scale):
+    num_chunks, k_chunk = k_chunks.shape[0], k_chunks.shape[3]
+    shape = tf.shape(q)
+    stats = tf.zeros(tf.stack([shape[0], shape[1], shape[2], 1]))
+    acc = tf.zeros(tf.stack([shape[0], shape[1], shape[2], v_chunks.shape[-1]]))
+
+    def body(i, running_max, total, acc):
+        score = tf.matmul(q, k_chunks[i], transpose_b=True)
+        score = tf.cast(score, "float32") * scale
+        # The zero padding of the last key chunk must get no weight
+        valid = tf.range(k_chunk) + i * k_chunk < k_len
+        score = tf.where(valid, score, float("-inf"))
+        new_max = tf.maximum(running_max, tf.reduce_max(score, axis=-1, keepdims=True))
+        correction = tf.exp(running_max - new_max)
+        weights = tf.exp(score - new_max)
+        total = total * correction + tf.reduce_sum(weights, axis=-1, keepdims=True)
+        acc = acc * correction + tf.matmul(weights, tf.cast(v_chunks[i], "float32"))
+        return i + 1, new_max, total, acc
+
+    _, _, total, acc = tf.while_loop(
+        lambda i, *_: i < num_chunks,
+        body,
+        (tf.constant(0), stats - float("inf"), stats, acc),
+        parallel_iterations=1,
+    )
+    return tf.cast(acc / total, q.dtype)
+
+
+def _split_chunks(x, chunk):
+    # (bs, heads, time, d) -> (num_chunks, bs, heads, chunk, d), zero padded
+    num_chunks = -(-x.shape[2] // chunk)
+    x = tf.pad(x, [[0, 0], [0, 0], [0, num_chunks * chunk - x.shape[2]], [0, 0]])
+    x = tf.reshape(x, (-1, x.shape[1], num_chunks, chunk, x.shape[3]))
+    return tf.transpose(x, (2, 0, 1, 3, 4))
+
+
+def _merge_chunks(x, length):
+    num_chunks, _, heads, chunk, d = x.shape
+    x = tf.transpose(x, (1, 2, 0, 3, 4))
+    return tf.reshape(x, (-1, heads, num_chunks * chunk, d))[:, :, :length]
+
+
+def set_attention_memory_budget(model, memory_budget):
+    # `memory_budget` is in bytes per sample; None restores full attention
+    for module in model.submodules:
+        if hasattr(module, "memory_budget"):
+            module.memory_budget = memory_budget
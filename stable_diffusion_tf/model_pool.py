@@ -0,0 +1,78 @@
+import math
+import threading
+
+from .autoencoder_kl import Decoder, Encoder
+from .diffusion_model import UNetModel
+from .stable_diffusion import build_models, load_weights, weights_fingerprint
+from .weights import load_native_weights
+
+
+def _find_layer(model, cls):
+    return next(layer for layer in model.layers if isinstance(layer, cls))
+
+
+class ModelPool:
+    """Models for several resolutions that share one set of weights.
+
+    Keras graphs have fixed input shapes, so each resolution bucket gets its
+    own functional models, built on first use. They are wired from the same
+    UNet, VAE and text encoder layers, so weights are loaded (and held in
+    memory) once no matter how many buckets are served. Requested sizes snap
+    to the bucket with the closest aspect ratio, then the closest area.
+    """
+
+    def __init__(self, buckets=((512, 512),), download_weights=True, weights_path=None):
+        buckets = [tuple(bucket) for bucket in buckets]
+        for height, width in buckets:
+            if height % 64 or width % 64:
+                raise ValueError(
+                    "Resolution buckets must be multiples of 64, got %dx%d" % (width, height)
+                )
+        self.buckets = buckets
+        self._lock = threading.Lock()
+
+        models = build_models(*buckets[0])
+        if weights_path is not None:
+            load_native_weights(models, weights_path)
+        elif download_weights:
+            load_weights(*models)
+        self.text_encoder = models[0]
+        self.unet = _find_layer(models[1], UNetModel)
+        self.vae_decoder = _find_layer(models[2], Decoder)
+        self.vae_encoder = _find_layer(models[3], Encoder)
+        self._models = {buckets[0]: models}
+        self.update_namespace()
+
+    def update_namespace(self):
+        # Text embedding cache namespace of generators using the pool, tied
+        # to the text encoder weights like that of a standalone generator
+        self.namespace = weights_fingerprint(self.text_encoder)
+
+    def snap(self, img_height, img_width):
+        aspect = math.log(img_height / img_width)
+        return min(
+            self.buckets,
+            key=lambda bucket: (
+                round(abs(math.log(bucket[0] / bucket[1]) - aspect), 6),
+                abs(bucket[0] * bucket[1] - img_height * img_width),
+            ),
+        )
+
+    def get(self, img_height, img_width):
+        # (text_encoder, diffusion_model, decoder, encoder) for the bucket
+        # that (img_height, img_width) snaps to
+        bucket = self.snap(img_height, img_width)
+        with self._lock:
+            if bucket not in self._models:
+                self._models[bucket] = build_models(
+                    *bucket,
+                    text_encoder=self.text_encoder,
+                    unet=self.unet,
+                    vae_decoder=self.vae_decoder,
+                    vae_encoder=self.vae_encoder,
+                )
+            return self._models[bucket]
+
+    def built_models(self):
+        with self._lock:
+            return list(self._models.values())
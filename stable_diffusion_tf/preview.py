@@ -0,0 +1,39 @@
+import numpy as np
+
+# Linear map from Stable Diffusion 1.x latents (already scaled by 0.18215) to
+# RGB in [-1, 1], fitted by least squares against full decoder outputs
+LATENT_RGB_FACTORS = np.array(
+    [
+        [0.298, 0.207, 0.208],
+        [0.187, 0.286, 0.173],
+        [-0.158, 0.189, 0.264],
+        [-0.184, -0.271, -0.473],
+    ],
+    dtype=np.float32,
+)
+
+
+def latent_to_rgb(latent, factors=LATENT_RGB_FACTORS, bias=None, upscale=1):
+    # Cheap preview of a latent without running the VAE decoder
+    rgb = np.asarray(latent, dtype=np.float32) @ factors
+    if bias is not None:
+        rgb = rgb + bias
+    rgb = ((rgb + 1) / 2) * 255
+    if upscale > 1:
+        rgb = rgb.repeat(upscale, axis=1).repeat(upscale, axis=2)
+    return np.clip(rgb, 0, 255).astype("uint8")
+
+
+def fit_latent_rgb_factors(latents, images):
+    # Refit the projection (and a bias) for other weights from pairs of
+    # latents and their decoded uint8 images
+    latents = np.asarray(latents, dtype=np.float32)
+    images = np.asarray(images, dtype=np.float32) / 127.5 - 1
+    b, h, w, _ = latents.shape
+    images = images.reshape(b, h, images.shape[1] // h, w, images.shape[2] // w, 3)
+    images = images.mean(axis=(2, 4))
+
+    x = latents.reshape(-1, 4)
+    x = np.concatenate([x, np.ones((len(x), 1), dtype=np.float32)], axis=1)
+    coefficients = np.linalg.lstsq(x, images.reshape(-1, 3), rcond=None)[0]
+    return coefficients[:4], coefficients[4]
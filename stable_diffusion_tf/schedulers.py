@@ -0,0 +1,254 @@
+import math
+
+import numpy as np
+
+from .constants import _ALPHAS_CUMPROD
+
+_ALPHAS = np.array(_ALPHAS_CUMPROD, dtype=np.float64)
+_SIGMAS = np.sqrt((1 - _ALPHAS) / _ALPHAS)
+
+
+class Scheduler:
+    # Schedules are kept in ascending timestep order like the original DDIM
+    # loop. `step` is called from the last index down to 0, and the step at
+    # index 0 lands on the clean sample (alphas_prev[0] == 1).
+    graph_compatible = False
+
+    def __init__(self):
+        self.timesteps = None
+        self.alphas = None
+        self.alphas_prev = None
+
+    def set_timesteps(self, num_steps):
+        timesteps, alphas = self.get_schedule(num_steps)
+        self.timesteps = timesteps
+        self.alphas = list(alphas)
+        self.alphas_prev = [1.0] + self.alphas[:-1]
+        self.reset()
+
+    def get_schedule(self, num_steps):
+        raise NotImplementedError
+
+    def reset(self):
+        pass
+
+    def add_noise(self, latent, noise, index):
+        a_t = self.alphas[index]
+        return math.sqrt(a_t) * latent + math.sqrt(1 - a_t) * noise
+
+    def step(self, latent, e_t, index):
+        raise NotImplementedError
+
+
+def linspace_schedule(num_steps):
+    timesteps = np.linspace(0, 999, num_steps + 1).round()[1:].astype("int64")
+    return timesteps, _ALPHAS[timesteps]
+
+
+def karras_schedule(num_steps, rho=7.0):
+    sigma_min, sigma_max = _SIGMAS[0], _SIGMAS[-1]
+    ramp = np.linspace(0, 1, num_steps)
+    sigmas = (
+        sigma_max ** (1 / rho)
+        + ramp * (sigma_min ** (1 / rho) - sigma_max ** (1 / rho))
+    ) ** rho
+    sigmas = sigmas[::-1]
+    # Map each sigma back onto a (fractional) model timestep
+    timesteps = np.interp(np.log(sigmas), np.log(_SIGMAS), np.arange(len(_SIGMAS)))
+    return timesteps, 1 / (1 + sigmas**2)
+
+
+def _vp_coefficients(a):
+    alpha, sigma = math.sqrt(a), math.sqrt(1 - a)
+    return alpha, sigma, math.log(alpha / sigma)
+
+
+class DDIMScheduler(Scheduler):
+    graph_compatible = True
+
+    def get_schedule(self, num_steps):
+        timesteps = np.arange(1, 1000, 1000 // num_steps)
+        return timesteps, _ALPHAS[timesteps]
+
+    def step(self, latent, e_t, index):
+        a_t, a_prev = self.alphas[index], self.alphas_prev[index]
+        pred_x0 = (latent - math.sqrt(1 - a_t) * e_t) / math.sqrt(a_t)
+        latent = math.sqrt(a_prev) * pred_x0 + math.sqrt(1 - a_prev) * e_t
+        return latent, pred_x0
+
+
+class EulerScheduler(DDIMScheduler):
+    # For an epsilon-predicting model a deterministic Euler step in sigma
+    # space is exactly the DDIM update, so only the spacing differs
+    def __init__(self, karras_sigmas=True):
+        super().__init__()
+        self.karras_sigmas = karras_sigmas
+
+    def get_schedule(self, num_steps):
+        if self.karras_sigmas:
+            return karras_schedule(num_steps)
+        return linspace_schedule(num_steps)
+
+
+class LMSScheduler(Scheduler):
+    def __init__(self, order=4, karras_sigmas=False):
+        super().__init__()
+        self.order = order
+        self.karras_sigmas = karras_sigmas
+
+    def get_schedule(self, num_steps):
+        if self.karras_sigmas:
+            return karras_schedule(num_steps)
+        return linspace_schedule(num_steps)
+
+    def reset(self):
+        self._sigmas = []
+        self._derivatives = []
+
+    def step(self, latent, e_t, index):
+        a_t, a_prev = self.alphas[index], self.alphas_prev[index]
+        sigma = math.sqrt((1 - a_t) / a_t)
+        sigma_next = math.sqrt((1 - a_prev) / a_prev)
+
+        # Work on the variance-exploding sample x / sqrt(alpha), whose
+        # derivative with respect to sigma is the predicted noise
+        x = latent / math.sqrt(a_t)
+        pred_x0 = x - sigma * e_t
+
+        self._sigmas = (self._sigmas + [sigma])[-self.order :]
+        self._derivatives = (self._derivatives + [e_t])[-self.order :]
+        for j, d in enumerate(self._derivatives):
+            x = x + _lms_coefficient(self._sigmas, j, sigma, sigma_next) * d
+        return x * math.sqrt(a_prev), pred_x0
+
+
+def _lms_coefficient(nodes, j, start, end):
+    # Integral of the j-th Lagrange basis polynomial over [start, end]
+    others = [n for k, n in enumerate(nodes) if k != j]
+    # np.poly([]) is the scalar 1.0, which np.polyint does not accept
+    poly = np.atleast_1d(np.poly(others)) / np.prod([nodes[j] - n for n in others])
+    antiderivative = np.polyint(poly)
+    return np.polyval(antiderivative, end) - np.polyval(antiderivative, start)
+
+
+class DPMSolverMultistepScheduler(Scheduler):
+    # DPM-Solver++(2M), Lu et al. 2022
+    def get_schedule(self, num_steps):
+        return linspace_schedule(num_steps)
+
+    def reset(self):
+        self._prev_x0 = None
+        self._prev_lambda = None
+
+    def step(self, latent, e_t, index):
+        alpha_s, sigma_s, lambda_s = _vp_coefficients(self.alphas[index])
+        pred_x0 = (latent - sigma_s * e_t) / alpha_s
+
+        if index == 0:
+            latent = pred_x0
+        else:
+            alpha_t, sigma_t, lambda_t = _vp_coefficients(self.alphas_prev[index])
+            h = lambda_t - lambda_s
+            d = pred_x0
+            if self._prev_x0 is not None:
+                r = (lambda_s - self._prev_lambda) / h
+                d = (1 + 1 / (2 * r)) * pred_x0 - (1 / (2 * r)) * self._prev_x0
+            latent = (sigma_t / sigma_s) * latent - alpha_t * math.expm1(-h) * d
+
+        self._prev_x0, self._prev_lambda = pred_x0, lambda_s
+        return latent, pred_x0
+
+
+class UniPCMultistepScheduler(Scheduler):
+    # UniPC with the B(h) = expm1(h) variant, order 2, Zhao et al. 2023
+    def get_schedule(self, num_steps):
+        return linspace_schedule(num_steps)
+
+    def reset(self):
+        self._history = []  # (pred_x0, a) of previous steps, newest last
+        self._last_sample = None
+        self._last_order = 1
+
+    def step(self, latent, e_t, index):
+        a_t = self.alphas[index]
+        alpha_t, sigma_t, _ = _vp_coefficients(a_t)
+        pred_x0 = (latent - sigma_t * e_t) / alpha_t
+        if index == 0:
+            return pred_x0, pred_x0
+
+        # Correct the current sample with the model output it produced,
+        # then predict the next one from the corrected sample
+        if self._last_sample is not None:
+            latent = self._update(
+                self._last_sample, self._history, a_t, self._last_order, pred_x0
+            )
+        self._history = (self._history + [(pred_x0, a_t)])[-2:]
+        self._last_sample = latent
+        self._last_order = len(self._history)
+        latent = self._update(
+            latent, self._history, self.alphas_prev[index], self._last_order
+        )
+        return latent, pred_x0
+
+    def _update(self, x, history, a_t, order, corrector_x0=None):
+        m0, a_s0 = history[-1]
+        alpha_s0, sigma_s0, lambda_s0 = _vp_coefficients(a_s0)
+        alpha_t, sigma_t, lambda_t = _vp_coefficients(a_t)
+        h = lambda_t - lambda_s0
+        hh = -h
+        h_phi_1 = math.expm1(hh)
+        b_h = math.expm1(hh)
+        x_t = (sigma_t / sigma_s0) * x - alpha_t * h_phi_1 * m0
+
+        rks, d1s = [], []
+        if order == 2:
+            m1, a_s1 = history[-2]
+            r1 = (_vp_coefficients(a_s1)[2] - lambda_s0) / h
+            rks.append(r1)
+            d1s.append((m1 - m0) / r1)
+        rks.append(1.0)
+
+        h_phi_k = h_phi_1 / hh - 1
+        factorial = 1
+        r_rows, b = [], []
+        for i in range(1, order + 1):
+            r_rows.append([rk ** (i - 1) for rk in rks])
+            b.append(h_phi_k * factorial / b_h)
+            factorial *= i + 1
+            h_phi_k = h_phi_k / hh - 1 / factorial
+
+        if corrector_x0 is None:
+            if not d1s:
+                return x_t
+            return x_t - alpha_t * b_h * 0.5 * d1s[0]
+
+        if order == 1:
+            rhos = [0.5]
+        else:
+            rhos = np.linalg.solve(np.array(r_rows), np.array(b))
+        res = rhos[-1] * (corrector_x0 - m0)
+        for rho, d1 in zip(rhos[:-1], d1s):
+            res = res + rho * d1
+        return x_t - alpha_t * b_h * res
+
+
+SCHEDULERS = {
+    "ddim": DDIMScheduler,
+    "euler": EulerScheduler,
+    "lms": LMSScheduler,
+    "dpm++": DPMSolverMultistepScheduler,
+    "unipc": UniPCMultistepScheduler,
+}
+
+
+def get_scheduler(scheduler=None):
+    if scheduler is None:
+        return DDIMScheduler()
+    if isinstance(scheduler, Scheduler):
+        return scheduler
+    if scheduler not in SCHEDULERS:
+        raise ValueError(
+            "Unknown scheduler %r, expected one of %s"
+            % (scheduler, ", ".join(SCHEDULERS))
+        )
+    return SCHEDULERS[scheduler]()
@@ -1,41 +1,215 @@
 import numpy as np
 from tqdm import tqdm
+import copy
+import hashlib
 import math
+import warnings
+from collections import namedtuple
+from types import SimpleNamespace
 
 import tensorflow as tf
 from tensorflow import keras
 
 from .autoencoder_kl import Decoder, Encoder
-from .diffusion_model import UNetModel
+from .cancellation import GenerationCancelled, GenerationResult, check_interrupt
+from .ckpt_loader import load_state_dict
+from .diffusion_model import DeepCache, UNetModel
+from .layers import set_attention_memory_budget
 from .clip_encoder import CLIPTextTransformer
 from .clip_tokenizer import SimpleTokenizer
+from .compile_cache import CompilationCache
 from .constants import _UNCONDITIONAL_TOKENS, _ALPHAS_CUMPROD, PYTORCH_CKPT_MAPPING
+from .preview import latent_to_rgb
+from .schedulers import get_scheduler
+from .text_embedding_cache import TextEmbeddingCache
+from .tiled_vae import decode_tiled, encode_tiled
+from .tiling import blend_weights, tile_starts
+from .weights import load_native_weights
+from .token_merging import set_token_merging
 from PIL import Image
 
 MAX_TEXT_LEN = 77
 
 
+
+class SamplingStep(namedtuple("SamplingStep", ["index", "timestep", "latent", "pred_x0"])):
+    def preview(self, upscale=8):
+        # Low-fidelity RGB of the current clean-image estimate, no decoder pass
+        return latent_to_rgb(self.pred_x0, upscale=upscale)
+
+
+class SamplingRun:
+    """Iterator over the SamplingSteps of one `generate_iter` call.
+
+    Interruptions are checked between steps like in `generate` and raise
+    GenerationCancelled from the iteration.
+    """
+
+    def __init__(self, generator, state, callback=None, cancel_token=None, deadline=None):
+        self._generator = generator
+        self._state = state
+        self._callback = callback
+        self._cancel_token = cancel_token
+        self._deadline = deadline
+        self._steps = self._run()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._steps)
+
+    def _run(self):
+        num_steps = len(self._state.timesteps)
+        steps_completed = 0
+        status = check_interrupt(self._cancel_token, self._deadline)
+        steps = self._generator._denoise(self._state) if status is None else []
+        for step in steps:
+            steps_completed += 1
+            if self._callback is not None:
+                self._callback(step)
+            yield step
+            if step.index > 0:
+                status = check_interrupt(self._cancel_token, self._deadline)
+                if status is not None:
+                    break
+        if status is not None:
+            raise GenerationCancelled(
+                GenerationResult(None, status, steps_completed, num_steps)
+            )
+
+    def decode(self, step, use_pred_x0=False):
+        # Decodes a step the way `generate` does, merging inpainting
+        # results back into the input image
+        latent = step.pred_x0 if use_pred_x0 else step.latent
+        return self._generator.decode_latent(
+            latent, self._state.input_image_array, self._state.input_mask_array
+        )
+
+
 class StableDiffusion:
-    def __init__(self, img_height=1000, img_width=1000, jit_compile=False, download_weights=True):
+    def __init__(
+        self,
+        img_height=1000,
+        img_width=1000,
+        jit_compile=False,
+        download_weights=True,
+        batch_guidance=True,
+        graph_sampling=False,
+        text_embedding_cache=None,
+        attention_memory_budget=None,
+        tiled_decode=False,
+        tiled_encode_threshold=1024 * 1024,
+        model_pool=None,
+        compilation_cache_dir=None,
+        weights_path=None,
+    ):
+        if model_pool is not None:
+            img_height, img_width = model_pool.snap(img_height, img_width)
         self.img_height = img_height
         self.img_width = img_width
+        self.jit_compile = jit_compile
+        # Run the conditional and unconditional UNet passes as one batch
+        self.batch_guidance = batch_guidance
+        # Run the whole denoising loop as one tf.function (XLA-compiled
+        # when jit_compile is set) instead of stepping from Python
+        self.graph_sampling = graph_sampling
+        # Decode in overlapping latent tiles to bound decoder memory
+        self.tiled_decode = tiled_decode
+        # Input images with more pixels than this after resizing to the
+        # model size are encoded in tiles (None never tiles)
+        self.tiled_encode_threshold = tiled_encode_threshold
+        self._sampling_loop = None
+        self._deep_cache_functions = {}
+        # Warmed-up batch sizes by id of the model, shared with siblings
+        # from for_resolution
+        self._batch_buckets = {}
+        # Input signatures each model's predict function has run with since
+        # it was last rebuilt, and how many it has seen in total (see
+        # compile_counts); also shared with siblings
+        self._input_signatures = {}
+        self._compile_counts = {}
         self.tokenizer = SimpleTokenizer()
+        if text_embedding_cache is None:
+            text_embedding_cache = TextEmbeddingCache()
+        self.text_embedding_cache = text_embedding_cache
+        # Without an explicit namespace, cached contexts are tied to the
+        # text encoder weights they were computed with
+        self._derive_cache_namespace = text_embedding_cache.namespace is None
+
+        # Models of other resolutions that share these weights come from
+        # the pool (see for_resolution)
+        self.model_pool = model_pool
+        if model_pool is None:
+            models = get_models(
+                img_height,
+                img_width,
+                download_weights=download_weights and weights_path is None,
+            )
+            if weights_path is not None:
+                # Directory written by save_native_weights
+                load_native_weights(models, weights_path)
+        else:
+            models = model_pool.get(img_height, img_width)
+        # XLA executables persist across processes under this directory,
+        # which TF_XLA_FLAGS has to name before TensorFlow is imported
+        self.compilation_cache = None
+        if compilation_cache_dir is not None and jit_compile:
+            self.compilation_cache = CompilationCache(compilation_cache_dir)
+            self.compilation_cache.enable()
+        self._set_models(*models)
+        self._update_cache_namespace()
+        if attention_memory_budget is not None:
+            set_attention_memory_budget(self.diffusion_model, attention_memory_budget)
+
+        self.dtype = tf.float32
+        if tf.keras.mixed_precision.global_policy().name == 'mixed_float16':
+            self.dtype = tf.float16
 
-        text_encoder, diffusion_model, decoder, encoder = get_models(img_height, img_width, download_weights=download_weights)
+    def _set_models(self, text_encoder, diffusion_model, decoder, encoder):
         self.text_encoder = text_encoder
         self.diffusion_model = diffusion_model
         self.decoder = decoder
         self.encoder = encoder
 
-        if jit_compile:
-            self.text_encoder.compile(jit_compile=True)
-            self.diffusion_model.compile(jit_compile=True)
-            self.decoder.compile(jit_compile=True)
-            self.encoder.compile(jit_compile=True)
+        if self.jit_compile:
+            # Compiling again would drop the traces of pooled models
+            for model in [text_encoder, diffusion_model, decoder, encoder]:
+                if not model._is_compiled:
+                    model.compile(jit_compile=True)
 
-        self.dtype = tf.float32
-        if tf.keras.mixed_precision.global_policy().name == 'mixed_float16':
-            self.dtype = tf.float16
+    def _update_cache_namespace(self):
+        if not self._derive_cache_namespace:
+            return
+        if self.model_pool is not None:
+            # Pooled generators share the pool's text encoder weights
+            self.text_embedding_cache.namespace = self.model_pool.namespace
+        else:
+            self.text_embedding_cache.namespace = weights_fingerprint(self.text_encoder)
+
+    def for_resolution(self, img_height, img_width):
+        # A generator for another output size that shares this one's
+        # weights, caches and settings. With a model pool the size snaps to
+        # its buckets and the models are built once per bucket.
+        if self.model_pool is not None:
+            img_height, img_width = self.model_pool.snap(img_height, img_width)
+            models = self.model_pool.get(img_height, img_width)
+        else:
+            models = build_models(
+                img_height,
+                img_width,
+                text_encoder=self.text_encoder,
+                unet=self.unet,
+                vae_decoder=self.vae_decoder,
+                vae_encoder=self.vae_encoder,
+            )
+        sibling = copy.copy(self)
+        sibling.img_height = img_height
+        sibling.img_width = img_width
+        sibling._set_models(*models)
+        sibling._sampling_loop = None
+        sibling._deep_cache_functions = {}
+        return sibling
 
     def generate(
         self,
@@ -49,20 +223,230 @@ class StableDiffusion:
         input_image=None,
         input_mask=None,
         input_image_strength=0.5,
+        scheduler=None,
+        seeds=None,
+        guidance_interval=None,
+        adaptive_guidance_threshold=None,
+        deep_cache_interval=None,
+        deep_cache_depth=0,
+        callback=None,
+        cancel_token=None,
+        deadline=None,
+        on_deadline="abort",
+        return_status=False,
+    ):
+        # `cancel_token` and `deadline` (a time.time() timestamp) are checked
+        # between steps. Past the deadline the call either aborts or, with
+        # on_deadline="decode", decodes the current clean-image estimate.
+        if on_deadline not in ("abort", "decode"):
+            raise ValueError("on_deadline must be 'abort' or 'decode'")
+        state = self._prepare(
+            prompt,
+            negative_prompt=negative_prompt,
+            batch_size=batch_size,
+            num_steps=num_steps,
+            unconditional_guidance_scale=unconditional_guidance_scale,
+            temperature=temperature,
+            seed=seed,
+            input_image=input_image,
+            input_mask=input_mask,
+            input_image_strength=input_image_strength,
+            scheduler=scheduler,
+            seeds=seeds,
+            guidance_interval=guidance_interval,
+            adaptive_guidance_threshold=adaptive_guidance_threshold,
+            deep_cache_interval=deep_cache_interval,
+            deep_cache_depth=deep_cache_depth,
+        )
+        num_steps = len(state.timesteps)
+        steps_completed = 0
+        status = check_interrupt(cancel_token, deadline)
+
+        # Diffusion stage
+        latent = pred_x0 = state.latent
+        if status is not None:
+            pass
+        elif (
+            self.graph_sampling
+            and state.scheduler.graph_compatible
+            and state.latent_mask is None
+            and state.adaptive_guidance_threshold is None
+            and state.deep_cache is None
+            and callback is None
+            and cancel_token is None
+            and deadline is None
+        ):
+            latent = self.sample_in_graph(
+                latent,
+                state.timesteps,
+                state.scheduler.alphas,
+                state.scheduler.alphas_prev,
+                state.context,
+                state.unconditional_context,
+                state.unconditional_guidance_scale,
+                guided_steps=state.guided_steps,
+            )
+            steps_completed = num_steps
+        else:
+            for step in self._denoise(state, progress=True):
+                latent, pred_x0 = step.latent, step.pred_x0
+                steps_completed += 1
+                if callback is not None:
+                    callback(step)
+                if step.index > 0:
+                    status = check_interrupt(cancel_token, deadline)
+                    if status is not None:
+                        break
+
+        if status is None and cancel_token is not None and cancel_token.cancelled:
+            status = GenerationResult.CANCELLED
+
+        images = None
+        if status is None:
+            status = GenerationResult.COMPLETED
+            images = self.decode_latent(
+                latent, state.input_image_array, state.input_mask_array
+            )
+        elif (
+            status == GenerationResult.DEADLINE_ABORTED
+            and on_deadline == "decode"
+            and steps_completed > 0
+        ):
+            status = GenerationResult.DEADLINE_DECODED
+            images = self.decode_latent(
+                pred_x0, state.input_image_array, state.input_mask_array
+            )
+
+        result = GenerationResult(images, status, steps_completed, num_steps)
+        if return_status:
+            return result
+        if result.aborted:
+            raise GenerationCancelled(result)
+        return images
+
+    def generate_iter(self, prompt, callback=None, cancel_token=None, deadline=None, **kwargs):
+        # Takes the same arguments as `generate` and yields a SamplingStep
+        # after every denoising step; `run.decode(step)` gives the images.
+        # `on_deadline` and `return_status` are not taken: the caller already
+        # holds every step and can decode `step.pred_x0` on its own terms.
+        state = self._prepare(prompt, **kwargs)
+        return SamplingRun(self, state, callback, cancel_token, deadline)
+
+    def generate_canvas(
+        self,
+        prompt,
+        canvas_height,
+        canvas_width,
+        negative_prompt=None,
+        batch_size=1,
+        num_steps=25,
+        unconditional_guidance_scale=7.5,
+        seed=None,
+        scheduler=None,
+        window_overlap=16,
+        window_batch_size=4,
+        callback=None,
+    ):
+        # MultiDiffusion (Bar-Tal et al. 2023): every step the model runs on
+        # overlapping model-sized latent windows of the canvas, in batches,
+        # and the noise predictions are averaged with blend weights before
+        # one scheduler step on the whole canvas. `window_overlap` is in
+        # latent pixels.
+        n_h, n_w = self.img_height // 8, self.img_width // 8
+        canvas_h, canvas_w = canvas_height // 8, canvas_width // 8
+        if canvas_h < n_h or canvas_w < n_w:
+            raise ValueError(
+                "The canvas (%dx%d) must be at least the model size (%dx%d)"
+                % (canvas_width, canvas_height, self.img_width, self.img_height)
+            )
+        windows = [
+            (y, x)
+            for y in tile_starts(canvas_h, n_h, window_overlap)
+            for x in tile_starts(canvas_w, n_w, window_overlap)
+        ]
+        weights = blend_weights(n_h, n_w, window_overlap)[None, ..., None]
+
+        context = self.encode_text(np.array([self.tokenize(prompt)] * batch_size, "int32"))
+        if negative_prompt is None:
+            unconditional_tokens = [_UNCONDITIONAL_TOKENS] * batch_size
+        else:
+            unconditional_tokens = [self.tokenize(negative_prompt, "Negative prompt")] * batch_size
+        unconditional_context = self.encode_text(np.array(unconditional_tokens, "int32"))
+        scheduler = get_scheduler(scheduler)
+        scheduler.set_timesteps(num_steps)
+        seeds = self.get_seeds(batch_size, seed=seed, seeds=None)
+        latent = self.sample_noise(seeds, (canvas_h, canvas_w, 4))
+
+        for index, timestep in tqdm(list(enumerate(scheduler.timesteps))[::-1]):
+            e_t = np.zeros(latent.shape, "float32")
+            total = np.zeros((1, canvas_h, canvas_w, 1), "float32")
+            for i in range(0, len(windows), window_batch_size):
+                batch = windows[i : i + window_batch_size]
+                window_e_t = self.get_model_output(
+                    tf.concat([latent[:, y : y + n_h, x : x + n_w] for y, x in batch], axis=0),
+                    timestep,
+                    np.concatenate([context] * len(batch)),
+                    np.concatenate([unconditional_context] * len(batch)),
+                    unconditional_guidance_scale,
+                    len(batch) * batch_size,
+                )
+                window_e_t = np.asarray(window_e_t, "float32")
+                for j, (y, x) in enumerate(batch):
+                    e_t[:, y : y + n_h, x : x + n_w] += (
+                        window_e_t[j * batch_size : (j + 1) * batch_size] * weights
+                    )
+                    total[:, y : y + n_h, x : x + n_w] += weights
+            latent, pred_x0 = scheduler.step(latent, tf.cast(e_t / total, latent.dtype), index)
+            if callback is not None:
+                callback(SamplingStep(index, timestep, latent, pred_x0))
+
+        return self.decode_latent(latent, tiled=True)
+
+    def _prepare(
+        self,
+        prompt,
+        negative_prompt=None,
+        batch_size=1,
+        num_steps=25,
+        unconditional_guidance_scale=7.5,
+        temperature=1,
+        seed=None,
+        input_image=None,
+        input_mask=None,
+        input_image_strength=0.5,
+        scheduler=None,
+        seeds=None,
+        guidance_interval=None,
+        adaptive_guidance_threshold=None,
+        deep_cache_interval=None,
+        deep_cache_depth=0,
     ):
+        # `temperature` scaled the DDIM noise term, which is zero with
+        # eta = 0; it is still accepted for compatibility and has no effect.
+        # A batch may mix requests: prompts, negative prompts, seeds and
+        # guidance scales can all be given per sample as lists
+        for value in (prompt, negative_prompt, unconditional_guidance_scale, seeds):
+            if isinstance(value, (list, tuple)):
+                batch_size = len(value)
+                break
+        prompts = self._per_sample(prompt, batch_size, "prompt")
+        negative_prompts = self._per_sample(negative_prompt, batch_size, "negative_prompt")
+        unconditional_guidance_scale = np.reshape(
+            self._per_sample(unconditional_guidance_scale, batch_size, "unconditional_guidance_scale"),
+            (batch_size, 1, 1, 1),
+        ).astype("float32")
+
+        # Every sample gets its own seed so that its noise does not depend on
+        # the batch it is generated in
+        seeds = self.get_seeds(batch_size, seed=seed, seeds=seeds)
+
         # Tokenize prompt (i.e. starting context)
-        inputs = self.tokenizer.encode(prompt)
-        assert len(inputs) < 77, "Prompt is too long (should be < 77 tokens)"
-        phrase = inputs + [49407] * (77 - len(inputs))
-        phrase = np.array(phrase)[None].astype("int32")
-        phrase = np.repeat(phrase, batch_size, axis=0)
+        phrase = np.array([self.tokenize(p) for p in prompts]).astype("int32")
 
         # Encode prompt tokens (and their positions) into a "context vector"
-        pos_ids = np.array(list(range(77)))[None].astype("int32")
-        pos_ids = np.repeat(pos_ids, batch_size, axis=0)
-        context = self.text_encoder.predict_on_batch([phrase, pos_ids])
+        context = self.encode_text(phrase)
         
-        input_image_tensor = None
+        input_image_tensor = input_image_array = None
         if input_image is not None:
             if type(input_image) is str:
                 input_image = Image.open(input_image)
@@ -74,6 +458,7 @@ class StableDiffusion:
             input_image_array = np.array(input_image, dtype=np.float32)[None,...,:3]
             input_image_tensor = tf.cast((input_image_array / 255.0) * 2 - 1, self.dtype)
 
+        input_mask_array = latent_mask_tensor = None
         if type(input_mask) is str:
             input_mask = Image.open(input_mask)
             input_mask = input_mask.resize((self.img_width, self.img_height))
@@ -87,71 +472,194 @@ class StableDiffusion:
 
 
         # Tokenize negative prompt or use default padding tokens
-        unconditional_tokens = _UNCONDITIONAL_TOKENS
-        if negative_prompt is not None:
-            inputs = self.tokenizer.encode(negative_prompt)
-            assert len(inputs) < 77, "Negative prompt is too long (should be < 77 tokens)"
-            unconditional_tokens = inputs + [49407] * (77 - len(inputs))
+        unconditional_tokens = [
+            _UNCONDITIONAL_TOKENS if p is None else self.tokenize(p, "Negative prompt")
+            for p in negative_prompts
+        ]
 
         # Encode unconditional tokens (and their positions into an
         # "unconditional context vector"
-        unconditional_tokens = np.array(unconditional_tokens)[None].astype("int32")
-        unconditional_tokens = np.repeat(unconditional_tokens, batch_size, axis=0)
-        unconditional_context = self.text_encoder.predict_on_batch(
-            [unconditional_tokens, pos_ids]
+        unconditional_tokens = np.array(unconditional_tokens).astype("int32")
+        unconditional_context = self.encode_text(unconditional_tokens)
+        scheduler = get_scheduler(scheduler)
+        scheduler.set_timesteps(num_steps)
+        timesteps = scheduler.timesteps
+        input_img_noise_index = min(
+            int(len(timesteps) * input_image_strength), len(timesteps) - 1
         )
-        timesteps = np.arange(1, 1000, 1000 // num_steps)
-        input_img_noise_t = timesteps[ int(len(timesteps)*input_image_strength) ]
-        latent, alphas, alphas_prev = self.get_starting_parameters(
-            timesteps, batch_size, seed , input_image=input_image_tensor, input_img_noise_t=input_img_noise_t
+        # The input image is encoded once; inpainting re-noises this clean
+        # latent with the same noise at every step
+        input_latent = input_noise = None
+        if input_image is not None:
+            input_latent = tf.repeat(self.encode_image(input_image_tensor), batch_size, axis=0)
+            input_noise = self.sample_noise(
+                seeds, input_latent.shape[1:], stream=1, dtype=input_latent.dtype
+            )
+        latent = self.get_starting_latent(
+            scheduler,
+            seeds,
+            input_latent=input_latent,
+            input_noise=input_noise,
+            input_img_noise_index=input_img_noise_index,
         )
 
         if input_image is not None:
             timesteps = timesteps[: int(len(timesteps)*input_image_strength)]
 
-        # Diffusion stage
-        progbar = tqdm(list(enumerate(timesteps))[::-1])
+        # Guidance is only applied on steps whose position in the sampling
+        # run (0 = first step, 1 = end) falls inside `guidance_interval`. A
+        # scale of 1 cancels out, so those runs never need the unconditional
+        # branch.
+        guided_steps = np.ones(len(timesteps), dtype=bool)
+        if guidance_interval is not None:
+            start, end = guidance_interval
+            progress = (len(timesteps) - 1 - np.arange(len(timesteps))) / max(len(timesteps), 1)
+            guided_steps = (progress >= start) & (progress < end)
+        if np.all(unconditional_guidance_scale == 1):
+            guided_steps[:] = False
+
+        return SimpleNamespace(
+            batch_size=batch_size,
+            context=context,
+            unconditional_context=unconditional_context,
+            unconditional_guidance_scale=unconditional_guidance_scale,
+            scheduler=scheduler,
+            timesteps=timesteps,
+            latent=latent,
+            input_latent=input_latent,
+            input_noise=input_noise,
+            input_image_array=input_image_array,
+            input_mask_array=input_mask_array,
+            latent_mask=latent_mask_tensor,
+            guided_steps=guided_steps,
+            adaptive_guidance_threshold=adaptive_guidance_threshold,
+            deep_cache=self.get_deep_cache(deep_cache_interval, deep_cache_depth),
+        )
+
+    def _denoise(self, state, progress=False):
+        latent = state.latent
+        steps = list(enumerate(state.timesteps))[::-1]
+        progbar = tqdm(steps) if progress else steps
+        guidance_converged = False
         for index, timestep in progbar:
-            progbar.set_description(f"{index:3d} {timestep:3d}")
-            e_t = self.get_model_output(
-                latent,
-                timestep,
-                context,
-                unconditional_context,
-                unconditional_guidance_scale,
-                batch_size,
-            )
-            a_t, a_prev = alphas[index], alphas_prev[index]
-            latent, pred_x0 = self.get_x_prev_and_pred_x0(
-                latent, e_t, index, a_t, a_prev, temperature, seed
-            )
+            if progress:
+                progbar.set_description(f"{index:3d} {timestep:3.0f}")
+            guided = state.guided_steps[index] and not guidance_converged
+            if guided and state.adaptive_guidance_threshold is not None:
+                # Once the two branches agree closely enough the
+                # unconditional pass is dropped for the rest of the run
+                unconditional_e_t, e_t = self.get_guidance_branches(
+                    latent,
+                    timestep,
+                    state.context,
+                    state.unconditional_context,
+                    state.batch_size,
+                    deep_cache=state.deep_cache,
+                )
+                difference = np.linalg.norm(
+                    (e_t - unconditional_e_t).reshape(state.batch_size, -1), axis=1
+                ) / np.linalg.norm(e_t.reshape(state.batch_size, -1), axis=1)
+                guidance_converged = np.max(difference) < state.adaptive_guidance_threshold
+                e_t = unconditional_e_t + state.unconditional_guidance_scale * (
+                    e_t - unconditional_e_t
+                )
+            else:
+                e_t = self.get_model_output(
+                    latent,
+                    timestep,
+                    state.context,
+                    state.unconditional_context,
+                    state.unconditional_guidance_scale,
+                    state.batch_size,
+                    guidance=guided,
+                    deep_cache=state.deep_cache,
+                )
+            latent, pred_x0 = state.scheduler.step(latent, tf.cast(e_t, latent.dtype), index)
 
-            if input_mask is not None and input_image is not None:
+            if state.latent_mask is not None and state.input_latent is not None:
                 # If mask is provided, noise at current timestep will be added to input image.
                 # The intermediate latent will be merged with input latent.
-                latent_orgin, alphas, alphas_prev = self.get_starting_parameters(
-                    timesteps, batch_size, seed , input_image=input_image_tensor, input_img_noise_t=timestep
-                )
-                latent = latent_orgin * latent_mask_tensor + latent * (1- latent_mask_tensor)
+                latent_orgin = state.scheduler.add_noise(state.input_latent, state.input_noise, index)
+                latent = latent_orgin * state.latent_mask + latent * (1- state.latent_mask)
 
-        # Decoding stage
-        decoded = self.decoder.predict_on_batch(latent)
+            yield SamplingStep(index, timestep, latent, pred_x0)
+
+    def decode_latent(self, latent, input_image_array=None, input_mask_array=None, tiled=None):
+        # Decoding stage. Latents that do not match the decoder input shape
+        # are always decoded in tiles.
+        if tiled is None:
+            tiled = self.tiled_decode or tuple(latent.shape[1:3]) != tuple(
+                self.decoder.input_shape[1:3]
+            )
+        if tiled:
+            decoded = decode_tiled(self.vae_decoder, latent)
+        else:
+            decoded = self._predict(self.decoder, latent)
         decoded = ((decoded + 1) / 2) * 255
 
-        if input_mask is not None:
+        if input_mask_array is not None:
           # Merge inpainting output with original image
           decoded = input_image_array * (1-input_mask_array) + np.array(decoded) * input_mask_array
 
         return np.clip(decoded, 0, 255).astype("uint8")
 
+    def encode_image(self, image, tiled=None):
+        # `image` is scaled to [-1, 1]
+        if tiled is None:
+            tiled = (
+                self.tiled_encode_threshold is not None
+                and image.shape[1] * image.shape[2] > self.tiled_encode_threshold
+            ) or tuple(image.shape[1:3]) != tuple(self.encoder.input_shape[1:3])
+        if tiled:
+            return tf.cast(encode_tiled(self.vae_encoder, image), image.dtype)
+        return self._predict(self.encoder, image)
+
+    def _per_sample(self, value, batch_size, name):
+        if not isinstance(value, (list, tuple)):
+            return [value] * batch_size
+        if len(value) != batch_size:
+            raise ValueError(
+                "Got %d values for %s in a batch of %d" % (len(value), name, batch_size)
+            )
+        return list(value)
+
+    def tokenize(self, prompt, name="Prompt"):
+        inputs = self.tokenizer.encode(prompt)
+        assert len(inputs) < 77, "%s is too long (should be < 77 tokens)" % name
+        return inputs + [49407] * (77 - len(inputs))
+
+    def encode_text(self, tokens):
+        # Encode each distinct row once, serving repeats from the cache
+        rows = {}
+        for row in np.asarray(tokens, dtype="int32"):
+            rows.setdefault(row.tobytes(), row)
+        contexts = {}
+        for key, row in rows.items():
+            context = self.text_embedding_cache.get(row)
+            if context is not None:
+                contexts[key] = context
+        missing = [key for key in rows if key not in contexts]
+        if missing:
+            missing_tokens = np.stack([rows[key] for key in missing])
+            pos_ids = np.array(list(range(MAX_TEXT_LEN)))[None].astype("int32")
+            pos_ids = np.repeat(pos_ids, len(missing), axis=0)
+            encoded = self._predict(self.text_encoder, [missing_tokens, pos_ids])
+            for key, context in zip(missing, encoded):
+                self.text_embedding_cache.put(rows[key], context)
+                contexts[key] = context
+        return np.stack(
+            [contexts[row.tobytes()] for row in np.asarray(tokens, dtype="int32")]
+        ).astype(self.dtype.as_numpy_dtype)
+
     def timestep_embedding(self, timesteps, dim=320, max_period=10000):
         half = dim // 2
         freqs = np.exp(
             -math.log(max_period) * np.arange(0, half, dtype="float32") / half
         )
-        args = np.array(timesteps) * freqs
-        embedding = np.concatenate([np.cos(args), np.sin(args)])
-        return tf.convert_to_tensor(embedding.reshape(1, -1),dtype=self.dtype)
+        # One embedding row per timestep
+        args = np.array(timesteps, dtype="float32").reshape(-1, 1) * freqs
+        embedding = np.concatenate([np.cos(args), np.sin(args)], axis=-1)
+        return tf.convert_to_tensor(embedding, dtype=self.dtype)
 
     def add_noise(self, x , t , noise=None ):
         batch_size,w,h = x.shape[0] , x.shape[1] , x.shape[2]
@@ -162,6 +670,43 @@ class StableDiffusion:
 
         return  sqrt_alpha_prod * x + sqrt_one_minus_alpha_prod * noise
 
+    def get_seeds(self, batch_size, seed=None, seeds=None):
+        if seeds is not None:
+            if len(seeds) != batch_size:
+                raise ValueError(
+                    "Got %d seeds for a batch of %d" % (len(seeds), batch_size)
+                )
+            return [int(s) for s in seeds]
+        if seed is None:
+            return [int(s) for s in np.random.randint(0, 2**31 - 1, size=batch_size)]
+        return [seed + i for i in range(batch_size)]
+
+    def sample_noise(self, seeds, shape, stream=0, dtype=tf.float32):
+        # Stateless per-sample draws: (seed, stream) fully determines the noise
+        return tf.concat(
+            [
+                tf.random.stateless_normal(
+                    (1,) + tuple(shape), seed=[seed, stream], dtype=dtype
+                )
+                for seed in seeds
+            ],
+            axis=0,
+        )
+
+    def get_starting_latent(
+        self,
+        scheduler,
+        seeds,
+        input_latent=None,
+        input_noise=None,
+        input_img_noise_index=None,
+    ):
+        n_h = self.img_height // 8
+        n_w = self.img_width // 8
+        if input_latent is None:
+            return self.sample_noise(seeds, (n_h, n_w, 4))
+        return scheduler.add_noise(input_latent, input_noise, input_img_noise_index)
+
     def get_starting_parameters(self, timesteps, batch_size, seed,  input_image=None, input_img_noise_t=None):
         n_h = self.img_height // 8
         n_w = self.img_width // 8
@@ -183,18 +728,218 @@ class StableDiffusion:
         unconditional_context,
         unconditional_guidance_scale,
         batch_size,
+        guidance=True,
+        deep_cache=None,
     ):
-        timesteps = np.array([t])
-        t_emb = self.timestep_embedding(timesteps)
-        t_emb = np.repeat(t_emb, batch_size, axis=0)
-        unconditional_latent = self.diffusion_model.predict_on_batch(
-            [latent, t_emb, unconditional_context]
+        if not guidance or np.all(np.asarray(unconditional_guidance_scale) == 1):
+            # Only the conditional prediction is used without guidance, and a
+            # guidance scale of 1 reduces to it exactly
+            t_emb = self._get_t_emb(t, batch_size)
+            return self._run_unet([latent, t_emb, context], deep_cache, "cond")
+        unconditional_latent, latent = self.get_guidance_branches(
+            latent, t, context, unconditional_context, batch_size, deep_cache=deep_cache
         )
-        latent = self.diffusion_model.predict_on_batch([latent, t_emb, context])
         return unconditional_latent + unconditional_guidance_scale * (
             latent - unconditional_latent
         )
 
+    def _get_t_emb(self, t, batch_size):
+        # `t` is either one timestep for the whole batch or one per sample
+        timesteps = np.array(t).reshape(-1)
+        t_emb = np.array(self.timestep_embedding(timesteps))
+        if len(timesteps) == 1:
+            t_emb = np.repeat(t_emb, batch_size, axis=0)
+        return t_emb
+
+    def get_guidance_branches(
+        self, latent, t, context, unconditional_context, batch_size, deep_cache=None
+    ):
+        t_emb = self._get_t_emb(t, batch_size)
+        if self.batch_guidance:
+            # Stack both guidance branches along the batch axis so each step
+            # is a single UNet call, then split the prediction back up
+            output = self._run_unet(
+                [
+                    tf.concat([latent, latent], axis=0),
+                    np.concatenate([t_emb, t_emb], axis=0),
+                    np.concatenate([unconditional_context, context], axis=0),
+                ],
+                deep_cache,
+                "guided",
+            )
+            unconditional_latent, latent = np.split(output, 2, axis=0)
+        else:
+            unconditional_latent = self._run_unet(
+                [latent, t_emb, unconditional_context], deep_cache, "uncond"
+            )
+            latent = self._run_unet([latent, t_emb, context], deep_cache, "cond")
+        return unconditional_latent, latent
+
+    def _run_unet(self, inputs, deep_cache=None, key=None):
+        if deep_cache is None:
+            return self._predict(self.diffusion_model, inputs)
+        return deep_cache(inputs, key=key)
+
+    def _predict(self, model, inputs):
+        # Batches are padded up to the nearest size passed to `warmup`, so
+        # only warmed-up shapes are ever traced
+        batch_size = len(tf.nest.flatten(inputs)[0])
+        buckets = self._batch_buckets.get(id(model), [])
+        if buckets and batch_size > buckets[-1]:
+            warnings.warn(
+                "Batch of %d for %s is larger than the largest warmed-up batch "
+                "size %d and needs a new trace" % (batch_size, model.name, buckets[-1])
+            )
+        padded_size = next((size for size in buckets if size >= batch_size), batch_size)
+        if padded_size > batch_size:
+            inputs = tf.nest.map_structure(
+                lambda x: tf.concat(
+                    [x, tf.repeat(x[-1:], padded_size - batch_size, axis=0)], axis=0
+                ),
+                inputs,
+            )
+        signature = tuple(
+            (tuple(x.shape), tf.as_dtype(x.dtype).name) for x in tf.nest.flatten(inputs)
+        )
+        signatures = self._input_signatures.setdefault(id(model), set())
+        if signature not in signatures:
+            signatures.add(signature)
+            self._compile_counts[id(model)] = self._compile_counts.get(id(model), 0) + 1
+        return model.predict_on_batch(inputs)[:batch_size]
+
+    def warmup(self, buckets):
+        # Traces (and with jit_compile, compiles) every model for each
+        # (img_height, img_width, batch_size) bucket ahead of time. Later
+        # batches are padded up to the nearest warmed-up batch size. Other
+        # resolutions than this generator's need a model pool.
+        for img_height, img_width, batch_size in buckets:
+            generator = self
+            if (img_height, img_width) != (self.img_height, self.img_width):
+                if self.model_pool is None:
+                    raise ValueError(
+                        "Warming up %dx%d needs a model_pool" % (img_width, img_height)
+                    )
+                generator = self.for_resolution(img_height, img_width)
+            generator._warmup(batch_size)
+
+    def _warmup(self, batch_size):
+        n_h, n_w = self.img_height // 8, self.img_width // 8
+        dtype = self.dtype.as_numpy_dtype
+        text_inputs = [np.zeros((batch_size, MAX_TEXT_LEN), "int32")] * 2
+        unet_sizes = [batch_size, 2 * batch_size] if self.batch_guidance else [batch_size]
+        unet_inputs = [
+            [
+                np.zeros((size, n_h, n_w, 4), "float32"),
+                np.zeros((size, 320), dtype),
+                np.zeros((size, MAX_TEXT_LEN, 768), dtype),
+            ]
+            for size in unet_sizes
+        ]
+        # Input images are encoded once per request, then repeated
+        calls = [(self.text_encoder, text_inputs)]
+        calls += [(self.diffusion_model, inputs) for inputs in unet_inputs]
+        calls += [
+            (self.decoder, np.zeros((batch_size, n_h, n_w, 4), "float32")),
+            (self.encoder, np.zeros((1, self.img_height, self.img_width, 3), dtype)),
+        ]
+        for model, inputs in calls:
+            sizes = self._batch_buckets.setdefault(id(model), [])
+            size = len(tf.nest.flatten(inputs)[0])
+            if size not in sizes:
+                sizes.append(size)
+                sizes.sort()
+            self._predict(model, inputs)
+
+    def compile_counts(self):
+        # Number of distinct input signatures (shapes and dtypes) each model
+        # has been run with, counted again after its predict function is
+        # rebuilt. With jit_compile each one is an XLA compilation; Keras'
+        # relaxed-shape tracing may share one trace between several of them.
+        return {
+            name: self._compile_counts.get(id(getattr(self, name)), 0)
+            for name in ["text_encoder", "diffusion_model", "decoder", "encoder"]
+        }
+
+    def trace_counts(self):
+        # Traces of each model's predict function and of the tf.functions
+        # this generator owns (the graph sampling loop and the DeepCache UNet
+        # functions) since they were last built. A count that grows while
+        # serving is a retrace. The tiled VAE paths run eagerly.
+        counts = {}
+        for name in ["text_encoder", "diffusion_model", "decoder", "encoder"]:
+            function = getattr(self, name).predict_function
+            counts[name] = 0 if function is None else function.experimental_get_tracing_count()
+        if self._sampling_loop is not None:
+            counts["sampling_loop"] = self._sampling_loop.experimental_get_tracing_count()
+        for depth, (full, partial) in self._deep_cache_functions.items():
+            counts["deep_cache_full_%d" % depth] = full.experimental_get_tracing_count()
+            counts["deep_cache_partial_%d" % depth] = partial.experimental_get_tracing_count()
+        return counts
+
+    def set_token_merging(self, ratio=0.5, max_downsample=1):
+        set_token_merging(self.diffusion_model, ratio=ratio, max_downsample=max_downsample)
+        self._reset_compiled_functions()
+
+    def set_attention_memory_budget(self, memory_budget, vae_memory_budget=None):
+        # Bytes of attention scores allowed per sample; attention is then
+        # computed exactly in chunks that fit. None disables chunking.
+        # `vae_memory_budget` does the same for the autoencoder and keeps
+        # its default when not given.
+        set_attention_memory_budget(self.diffusion_model, memory_budget)
+        if vae_memory_budget is not None:
+            set_attention_memory_budget(self.decoder, vae_memory_budget)
+            set_attention_memory_budget(self.encoder, vae_memory_budget)
+        self._reset_compiled_functions()
+
+    def _reset_compiled_functions(self):
+        # Layer options are read while tracing, so traced functions have to
+        # be rebuilt after they change, for every resolution sharing them
+        if self.model_pool is not None:
+            models = self.model_pool.built_models()
+        else:
+            models = [(self.text_encoder, self.diffusion_model, self.decoder, self.encoder)]
+        for _, diffusion_model, decoder, encoder in models:
+            for model in [diffusion_model, decoder, encoder]:
+                model.predict_function = None
+                self._input_signatures.pop(id(model), None)
+        self._sampling_loop = None
+        self._deep_cache_functions = {}
+
+    @property
+    def unet(self):
+        return next(
+            layer for layer in self.diffusion_model.layers if isinstance(layer, UNetModel)
+        )
+
+    @property
+    def vae_decoder(self):
+        return next(layer for layer in self.decoder.layers if isinstance(layer, Decoder))
+
+    @property
+    def vae_encoder(self):
+        return next(layer for layer in self.encoder.layers if isinstance(layer, Encoder))
+
+    def get_deep_cache(self, interval, depth=0):
+        # The compiled full and partial UNet functions are shared by every
+        # generation; only the returned cache is per generation
+        if interval is None:
+            return None
+        if depth not in self._deep_cache_functions:
+            unet = self.unet
+            self._deep_cache_functions[depth] = (
+                tf.function(
+                    lambda inputs: unet.call_with_cache(inputs, cache_depth=depth),
+                    jit_compile=self.jit_compile,
+                ),
+                tf.function(
+                    lambda inputs, features: unet.call_with_cache(
+                        inputs, cache_depth=depth, cached_features=features
+                    )[0],
+                    jit_compile=self.jit_compile,
+                ),
+            )
+        return DeepCache(*self._deep_cache_functions[depth], interval=interval)
+
     def get_x_prev_and_pred_x0(self, x, e_t, index, a_t, a_prev, temperature, seed):
         sigma_t = 0
         sqrt_one_minus_at = math.sqrt(1 - a_t)
@@ -206,68 +951,199 @@ class StableDiffusion:
         x_prev = math.sqrt(a_prev) * pred_x0 + dir_xt
         return x_prev, pred_x0
 
+    def sample_in_graph(
+        self,
+        latent,
+        timesteps,
+        alphas,
+        alphas_prev,
+        context,
+        unconditional_context,
+        unconditional_guidance_scale,
+        guided_steps=None,
+    ):
+        if self._sampling_loop is None:
+            self._sampling_loop = tf.function(
+                self._ddim_sampling_loop, jit_compile=self.jit_compile
+            )
+        # Everything the loop needs is precomputed once, so the latent never
+        # leaves the device between the starting noise and the decoder
+        num_steps = len(timesteps)
+        if guided_steps is None:
+            guided_steps = np.ones(num_steps, dtype=bool)
+        t_embs = tf.concat([self.timestep_embedding([t]) for t in timesteps], axis=0)
+        return self._sampling_loop(
+            tf.cast(latent, tf.float32),
+            tf.convert_to_tensor(context),
+            tf.convert_to_tensor(unconditional_context),
+            t_embs,
+            tf.constant(alphas[:num_steps], dtype=tf.float32),
+            tf.constant(alphas_prev[:num_steps], dtype=tf.float32),
+            tf.constant(unconditional_guidance_scale, dtype=tf.float32, shape=(len(context), 1, 1, 1)),
+            tf.constant(guided_steps[:num_steps], dtype=tf.bool),
+        )
+
+    def _ddim_sampling_loop(
+        self,
+        latent,
+        context,
+        unconditional_context,
+        t_embs,
+        alphas,
+        alphas_prev,
+        unconditional_guidance_scale,
+        guided_steps,
+    ):
+        # A static batch size keeps the UNet output shape static; a batch of
+        # one broadcast against a dynamic one would lose it across iterations
+        batch_size = latent.shape[0]
+
+        def step(index, latent):
+            t_emb = tf.repeat(t_embs[index][None], batch_size, axis=0)
+
+            def conditional():
+                e_t = self.diffusion_model([latent, t_emb, context], training=False)
+                return tf.cast(e_t, latent.dtype)
+
+            def guided():
+                if self.batch_guidance:
+                    output = self.diffusion_model(
+                        [
+                            tf.concat([latent, latent], axis=0),
+                            tf.concat([t_emb, t_emb], axis=0),
+                            tf.concat([unconditional_context, context], axis=0),
+                        ],
+                        training=False,
+                    )
+                    unconditional_e_t, e_t = tf.split(output, 2, axis=0)
+                else:
+                    unconditional_e_t = self.diffusion_model(
+                        [latent, t_emb, unconditional_context], training=False
+                    )
+                    e_t = self.diffusion_model([latent, t_emb, context], training=False)
+                unconditional_e_t = tf.cast(unconditional_e_t, latent.dtype)
+                e_t = tf.cast(e_t, latent.dtype)
+                return unconditional_e_t + unconditional_guidance_scale * (
+                    e_t - unconditional_e_t
+                )
+
+            e_t = tf.cond(guided_steps[index], guided, conditional)
+
+            a_t, a_prev = alphas[index], alphas_prev[index]
+            pred_x0 = (latent - tf.sqrt(1 - a_t) * e_t) / tf.sqrt(a_t)
+            next_latent = tf.sqrt(a_prev) * pred_x0 + tf.sqrt(1 - a_prev) * e_t
+            return index - 1, tf.ensure_shape(next_latent, latent.shape)
+
+        _, latent = tf.while_loop(
+            lambda index, _: index >= 0,
+            step,
+            [tf.shape(t_embs)[0] - 1, latent],
+        )
+        return latent
+
     def load_weights_from_pytorch_ckpt(self , pytorch_ckpt_path):
-        import torch
-        pt_weights = torch.load(pytorch_ckpt_path, map_location="cpu")
+        # Reads the checkpoint without torch. Tensors are memory-mapped and
+        # assigned one at a time, so only one tensor is copied at any point.
+        state_dict = load_state_dict(pytorch_ckpt_path)
         for module_name in ['text_encoder', 'diffusion_model', 'decoder', 'encoder' ]:
-            module_weights = []
-            for i , (key , perm ) in enumerate(PYTORCH_CKPT_MAPPING[module_name]):
-                w = pt_weights['state_dict'][key].numpy()
+            module = getattr(self, module_name)
+            mapping = PYTORCH_CKPT_MAPPING[module_name]
+            if len(mapping) != len(module.weights):
+                raise ValueError(
+                    "%s has %d weights, the checkpoint mapping %d"
+                    % (module_name, len(module.weights), len(mapping))
+                )
+            for var, (key , perm ) in zip(module.weights, mapping):
+                w = state_dict[key].numpy()
                 if perm is not None:
                     w = np.transpose(w , perm )
-                module_weights.append(w)
-            getattr(self, module_name).set_weights(module_weights)
-            print("Loaded %d weights for %s"%(len(module_weights) , module_name))
+                if tuple(var.shape) != w.shape:
+                    raise ValueError(
+                        "Shape mismatch for %s: %s in the checkpoint, %s in %s"
+                        % (key, w.shape, tuple(var.shape), module_name)
+                    )
+                var.assign(w.astype(var.dtype.as_numpy_dtype, copy=False))
+            print("Loaded %d weights for %s"%(len(mapping) , module_name))
+        # Cached contexts belong to the previous text encoder weights
+        if self.model_pool is not None:
+            self.model_pool.update_namespace()
+        self._update_cache_namespace()
+
+def weights_fingerprint(model, samples=4096):
+    # Digest of the weight shapes and an evenly strided sample of each
+    # tensor's values, cheap enough to compute at every startup
+    digest = hashlib.sha1()
+    for weight in model.weights:
+        size = int(np.prod(weight.shape))
+        values = tf.reshape(weight, [-1])[:: max(1, size // samples)]
+        digest.update(str(tuple(weight.shape)).encode())
+        digest.update(np.asarray(values, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
 
 def get_models(img_height, img_width, download_weights=True):
+    models = build_models(img_height, img_width)
+    if download_weights:
+        load_weights(*models)
+    return models
+
+
+def build_models(
+    img_height, img_width, text_encoder=None, unet=None, vae_decoder=None, vae_encoder=None
+):
+    # Given the layers of already built models, the graphs for this
+    # resolution reuse them (and their weights) instead of new ones
     n_h = img_height // 8
     n_w = img_width // 8
 
     # Create text encoder
-    input_word_ids = keras.layers.Input(shape=(MAX_TEXT_LEN,), dtype="int32")
-    input_pos_ids = keras.layers.Input(shape=(MAX_TEXT_LEN,), dtype="int32")
-    embeds = CLIPTextTransformer()([input_word_ids, input_pos_ids])
-    text_encoder = keras.models.Model([input_word_ids, input_pos_ids], embeds)
+    if text_encoder is None:
+        input_word_ids = keras.layers.Input(shape=(MAX_TEXT_LEN,), dtype="int32")
+        input_pos_ids = keras.layers.Input(shape=(MAX_TEXT_LEN,), dtype="int32")
+        embeds = CLIPTextTransformer()([input_word_ids, input_pos_ids])
+        text_encoder = keras.models.Model([input_word_ids, input_pos_ids], embeds)
 
     # Creation diffusion UNet
     context = keras.layers.Input((MAX_TEXT_LEN, 768))
     t_emb = keras.layers.Input((320,))
     latent = keras.layers.Input((n_h, n_w, 4))
-    unet = UNetModel()
+    if unet is None:
+        unet = UNetModel()
     diffusion_model = keras.models.Model(
         [latent, t_emb, context], unet([latent, t_emb, context])
     )
 
     # Create decoder
     latent = keras.layers.Input((n_h, n_w, 4))
-    decoder = Decoder()
+    decoder = Decoder(None if vae_decoder is None else vae_decoder.layers)
     decoder = keras.models.Model(latent, decoder(latent))
 
     inp_img = keras.layers.Input((img_height, img_width, 3))
-    encoder = Encoder()
+    encoder = Encoder(None if vae_encoder is None else vae_encoder.layers)
     encoder = keras.models.Model(inp_img, encoder(inp_img))
+    return text_encoder, diffusion_model, decoder, encoder
 
-    if download_weights:
-        text_encoder_weights_fpath = keras.utils.get_file(
-            origin="https://huggingface.co/fchollet/stable-diffusion/resolve/main/text_encoder.h5",
-            file_hash="d7805118aeb156fc1d39e38a9a082b05501e2af8c8fbdc1753c9cb85212d6619",
-        )
-        diffusion_model_weights_fpath = keras.utils.get_file(
-            origin="https://huggingface.co/fchollet/stable-diffusion/resolve/main/diffusion_model.h5",
-            file_hash="a5b2eea58365b18b40caee689a2e5d00f4c31dbcb4e1d58a9cf1071f55bbbd3a",
-        )
-        decoder_weights_fpath = keras.utils.get_file(
-            origin="https://huggingface.co/fchollet/stable-diffusion/resolve/main/decoder.h5",
-            file_hash="6d3c5ba91d5cc2b134da881aaa157b2d2adc648e5625560e3ed199561d0e39d5",
-        )
 
-        encoder_weights_fpath = keras.utils.get_file(
-            origin="https://huggingface.co/divamgupta/stable-diffusion-tensorflow/resolve/main/encoder_newW.h5",
-            file_hash="56a2578423c640746c5e90c0a789b9b11481f47497f817e65b44a1a5538af754",
-        )
+def load_weights(text_encoder, diffusion_model, decoder, encoder):
+    text_encoder_weights_fpath = keras.utils.get_file(
+        origin="https://huggingface.co/fchollet/stable-diffusion/resolve/main/text_encoder.h5",
+        file_hash="d7805118aeb156fc1d39e38a9a082b05501e2af8c8fbdc1753c9cb85212d6619",
+    )
+    diffusion_model_weights_fpath = keras.utils.get_file(
+        origin="https://huggingface.co/fchollet/stable-diffusion/resolve/main/diffusion_model.h5",
+        file_hash="a5b2eea58365b18b40caee689a2e5d00f4c31dbcb4e1d58a9cf1071f55bbbd3a",
+    )
+    decoder_weights_fpath = keras.utils.get_file(
+        origin="https://huggingface.co/fchollet/stable-diffusion/resolve/main/decoder.h5",
+        file_hash="6d3c5ba91d5cc2b134da881aaa157b2d2adc648e5625560e3ed199561d0e39d5",
+    )
+
+    encoder_weights_fpath = keras.utils.get_file(
+        origin="https://huggingface.co/divamgupta/stable-diffusion-tensorflow/resolve/main/encoder_newW.h5",
+        file_hash="56a2578423c640746c5e90c0a789b9b11481f47497f817e65b44a1a5538af754",
+    )
 
-        text_encoder.load_weights(text_encoder_weights_fpath)
-        diffusion_model.load_weights(diffusion_model_weights_fpath)
-        decoder.load_weights(decoder_weights_fpath)
-        encoder.load_weights(encoder_weights_fpath)
-    return text_encoder, diffusion_model, decoder , encoder
+    text_encoder.load_weights(text_encoder_weights_fpath)
+    diffusion_model.load_weights(diffusion_model_weights_fpath)
+    decoder.load_weights(decoder_weights_fpath)
+    encoder.load_weights(encoder_weights_fpath)
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class TextEmbeddingCache:
+    """Bounded LRU cache of text encoder outputs keyed by token ids.
+
+    With `cache_dir` set, the contexts live in a memory-mapped array of
+    `max_entries` slots next to a JSON index, so the cache survives restarts.
+    `namespace` is mixed into every key and should change whenever the text
+    encoder weights do. Left as None, `StableDiffusion` derives it from the
+    text encoder weights. `get` returns copies, so later evictions cannot
+    change contexts that were already handed out.
+    """
+
+    def __init__(self, max_entries=128, cache_dir=None, context_shape=(77, 768), namespace=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.context_shape = tuple(context_shape)
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._store = None
+        if cache_dir is not None and max_entries > 0:
+            self._open_store()
+
+    def _key(self, token_ids):
+        token_ids = np.asarray(token_ids, dtype="int32")
+        namespace = (self.namespace or "").encode()
+        return hashlib.sha1(namespace + token_ids.tobytes()).hexdigest()
+
+    def _open_store(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        store_path = os.path.join(self.cache_dir, "embeddings.npy")
+        index_path = os.path.join(self.cache_dir, "index.json")
+        shape = (self.max_entries,) + self.context_shape
+        if os.path.exists(store_path) and os.path.exists(index_path):
+            store = np.lib.format.open_memmap(store_path, mode="r+")
+            if store.shape == shape and store.dtype == np.float32:
+                self._store = store
+                with open(index_path) as f:
+                    self._entries = OrderedDict(json.load(f))
+                return
+            del store
+        self._store = np.lib.format.open_memmap(
+            store_path, mode="w+", dtype=np.float32, shape=shape
+        )
+        self._entries = OrderedDict()
+        self._save_index()
+
+    def _save_index(self):
+        index_path = os.path.join(self.cache_dir, "index.json")
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(index_path + ".tmp", index_path)
+
+    def get(self, token_ids):
+        key = self._key(token_ids)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            if self._store is not None:
+                return np.array(self._store[self._entries[key]])
+            return np.array(self._entries[key])
+
+    def put(self, token_ids, context):
+        if self.max_entries <= 0:
+            return
+        key = self._key(token_ids)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            if self._store is None:
+                if len(self._entries) >= self.max_entries:
+                    self._entries.popitem(last=False)
+                self._entries[key] = np.array(context)
+                return
+
+            if len(self._entries) >= self.max_entries:
+                _, slot = self._entries.popitem(last=False)
+            else:
+                used = set(self._entries.values())
+                slot = next(i for i in range(self.max_entries) if i not in used)
+            self._store[slot] = context
+            self._store.flush()
+            self._entries[key] = slot
+            self._save_index()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            if self._store is not None:
+                self._save_index()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,81 @@
+import numpy as np
+import tensorflow as tf
+
+from .layers import apply_seq, set_group_norm_stats_mode
+from .tiling import blend_weights, tile_starts
+
+
+def decode_tiled(decoder, latent, tile_size=64, overlap=16, tile_batch_size=4):
+    # Decodes `latent` through the layers of a `Decoder` in overlapping
+    # tile_size x tile_size latent tiles, so activation memory does not grow
+    # with the output size. GroupNorm statistics are taken once per image from
+    # a downscaled decode and shared by every tile, which keeps tone and
+    # contrast consistent across seams; overlaps are blended linearly. The
+    # shared statistics are per thread, so concurrent calls of the same
+    # models are not affected.
+    outputs = []
+    for sample in np.asarray(latent, dtype="float32"):
+        outputs.append(_apply_with_shared_stats(
+            decoder, sample[None], tile_size, overlap, 8, tile_batch_size
+        ))
+    return np.stack(outputs)
+
+
+def encode_tiled(encoder, image, tile_size=512, overlap=64, tile_batch_size=4):
+    # Encodes `image` through the layers of an `Encoder` in overlapping pixel
+    # tiles (sizes in pixels, multiples of 8), merging the latents of the
+    # overlaps the same way `decode_tiled` merges pixels
+    outputs = []
+    for sample in np.asarray(image, dtype="float32"):
+        outputs.append(_apply_with_shared_stats(
+            encoder, sample[None], tile_size, overlap, 1 / 8, tile_batch_size
+        ))
+    return np.stack(outputs)
+
+
+def _apply_with_shared_stats(model, image, tile_size, overlap, ratio, tile_batch_size):
+    _, h, w, _ = image.shape
+    if h <= tile_size and w <= tile_size:
+        return np.asarray(apply_seq(tf.constant(image), model.layers), dtype="float32")[0]
+    try:
+        # Downscaled inputs of a downsampling model stay a multiple of its factor
+        align = max(1, round(1 / ratio))
+        scale = tile_size / max(h, w) / align
+        small = tf.image.resize(
+            image,
+            (max(1, round(h * scale)) * align, max(1, round(w * scale)) * align),
+            method="area",
+        )
+        set_group_norm_stats_mode(model, "record")
+        apply_seq(small, model.layers)
+        set_group_norm_stats_mode(model, "fixed")
+        return _apply_tiled(model, image, tile_size, overlap, ratio, tile_batch_size)
+    finally:
+        set_group_norm_stats_mode(model, None)
+
+
+def _apply_tiled(model, image, tile_size, overlap, ratio, tile_batch_size):
+    # `ratio` is the output size over the input size of `model`
+    _, h, w, _ = image.shape
+    tile_h, tile_w = min(tile_size, h), min(tile_size, w)
+    tiles = [
+        (y, x)
+        for y in tile_starts(h, tile_h, overlap)
+        for x in tile_starts(w, tile_w, overlap)
+    ]
+    weights = blend_weights(int(tile_h * ratio), int(tile_w * ratio), int(overlap * ratio))
+    weights = weights[..., None]
+
+    output = total = None
+    for i in range(0, len(tiles), tile_batch_size):
+        batch = tiles[i : i + tile_batch_size]
+        crops = np.concatenate([image[:, y : y + tile_h, x : x + tile_w] for y, x in batch])
+        results = np.asarray(apply_seq(tf.constant(crops), model.layers), dtype="float32")
+        if output is None:
+            output = np.zeros((int(h * ratio), int(w * ratio), results.shape[-1]), "float32")
+            total = np.zeros((int(h * ratio), int(w * ratio), 1), "float32")
+        for (y, x), result in zip(batch, results):
+            y, x = int(y * ratio), int(x * ratio)
+            output[y : y + result.shape[0], x : x + result.shape[1]] += result * weights
+            total[y : y + result.shape[0], x : x + result.shape[1]] += weights
+    return output / total
@@ -0,0 +1,20 @@
+import numpy as np
+
+
+def tile_starts(size, tile_size, overlap):
+    # Start offsets of tiles covering [0, size), the last one flush with the end
+    if size <= tile_size:
+        return [0]
+    stride = max(1, tile_size - overlap)
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+
+def blend_weights(tile_h, tile_w, overlap):
+    # Weights that ramp linearly across `overlap` at each tile edge. Outputs
+    # are divided by the summed weights, so borders of the canvas (which only
+    # one tile covers) come out unchanged.
+    def ramp(n):
+        i = np.arange(n, dtype=np.float32)
+        return np.minimum(1, np.minimum(i + 1, n - i) / (overlap + 1))
+
+    return np.outer(ramp(tile_h), ramp(tile_w))
@@ -0,0 +1,86 @@
+import numpy as np
+import tensorflow as tf
+
+def bipartite_soft_matching(metric, h, w, r, sx=2, sy=2):
+    # Token merging (Bolya & Hoffman 2023, "Token Merging for Fast Stable
+    # Diffusion"). The top-left token of every sy x sx cell is a destination,
+    # and the `r` source tokens most similar to a destination are averaged
+    # into it. Returns (merge, unmerge) for tensors shaped like `metric`.
+    if r <= 0 or h % sy or w % sx:
+        return _identity, _identity
+
+    grid = np.arange(h * w).reshape(h // sy, sy, w // sx, sx)
+    dst_tokens = grid[:, 0, :, 0].reshape(-1)
+    src_tokens = np.setdiff1d(np.arange(h * w), dst_tokens)
+    num_dst, num_src = len(dst_tokens), len(src_tokens)
+    r = min(r, num_src)
+    restore_order = np.argsort(np.concatenate([src_tokens, dst_tokens]))
+
+    metric = tf.math.l2_normalize(metric, axis=-1)
+    scores = tf.matmul(
+        tf.gather(metric, src_tokens, axis=1),
+        tf.gather(metric, dst_tokens, axis=1),
+        transpose_b=True,
+    )
+    node_max = tf.reduce_max(scores, axis=-1)
+    node_idx = tf.argmax(scores, axis=-1, output_type=tf.int32)
+    edge_idx = tf.argsort(node_max, axis=-1, direction="DESCENDING")
+    unm_idx = edge_idx[:, r:]  # sources that stay as they are
+    src_idx = edge_idx[:, :r]  # sources merged into a destination
+    dst_idx = tf.gather(node_idx, src_idx, batch_dims=1)
+    src_order = tf.argsort(tf.concat([unm_idx, src_idx], axis=1), axis=1)
+
+    batch_size = tf.shape(metric)[0]
+    segments = dst_idx + num_dst * tf.range(batch_size)[:, None]
+    segments = tf.reshape(segments, (-1,))
+
+    def merge(x):
+        c = x.shape[-1]
+        src = tf.gather(x, src_tokens, axis=1)
+        dst = tf.gather(x, dst_tokens, axis=1)
+        unm = tf.gather(src, unm_idx, batch_dims=1)
+        src = tf.reshape(tf.gather(src, src_idx, batch_dims=1), (-1, c))
+
+        # Average each destination with the sources merged into it
+        num_segments = batch_size * num_dst
+        merged = tf.math.unsorted_segment_sum(src, segments, num_segments)
+        counts = tf.math.unsorted_segment_sum(
+            tf.ones_like(src[:, :1]), segments, num_segments
+        )
+        merged = tf.reshape(merged, (-1, num_dst, c))
+        counts = tf.reshape(counts, (-1, num_dst, 1))
+        dst = (dst + merged) / (1 + counts)
+        return tf.concat([unm, dst], axis=1)
+
+    def unmerge(x):
+        unm = x[:, : num_src - r]
+        dst = x[:, num_src - r :]
+        src = tf.concat([unm, tf.gather(dst, dst_idx, batch_dims=1)], axis=1)
+        src = tf.gather(src, src_order, batch_dims=1)
+        return tf.gather(tf.concat([src, dst], axis=1), restore_order, axis=1)
+
+    return merge, unmerge
+
+
+def _identity(x):
+    return x
+
+
+def token_merge_ratio(setting, downsample):
+    # Ratio for a block at `downsample` (latent size over block size) given
+    # the (ratio, max_downsample) stored by set_token_merging
+    ratio, max_downsample = setting
+    if isinstance(ratio, dict):
+        return ratio.get(downsample, 0.0)
+    return ratio if downsample <= max_downsample else 0.0
+
+
+def set_token_merging(model, ratio=0.5, max_downsample=1):
+    # `ratio` is the fraction of self-attention tokens merged in each
+    # transformer block, either one value or a {downsample: ratio} dict
+    # (downsample 1, 2, 4 or 8 for the middle block). Blocks deeper than
+    # `max_downsample` are left alone.
+    setting = (ratio, max_downsample) if ratio else None
+    for module in model.submodules:
+        if hasattr(module, "token_merging"):
+            module.token_merging = setting
@@ -0,0 +1,101 @@
+import json
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# File layout: MAGIC, little-endian uint64 header size, a JSON header, then
+# every tensor at an ALIGNMENT-byte boundary so it can be memory-mapped
+MAGIC = b"SDTFW\x00\x00\x01"
+ALIGNMENT = 64
+COMPONENTS = ["text_encoder", "diffusion_model", "decoder", "encoder"]
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save_weight_file(model, path, dtype=None):
+    # `dtype` (e.g. "float16") stores floating point weights at a lower
+    # precision on disk; they are cast back to the variable dtype on load
+    tensors = []
+    offset = 0
+    for weight in model.weights:
+        value_dtype = np.dtype(weight.dtype.as_numpy_dtype)
+        if dtype is not None and value_dtype.kind == "f":
+            value_dtype = np.dtype(dtype)
+        shape = [int(d) for d in weight.shape]
+        nbytes = int(np.prod(shape)) * value_dtype.itemsize
+        tensors.append(
+            {
+                "name": weight.name,
+                "dtype": value_dtype.str,
+                "shape": shape,
+                "offset": offset,
+                "nbytes": nbytes,
+            }
+        )
+        offset = _align(offset + nbytes)
+
+    header = json.dumps({"tensors": tensors}).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        for weight, tensor in zip(model.weights, tensors):
+            f.seek(data_start + tensor["offset"])
+            f.write(np.ascontiguousarray(weight.numpy(), dtype=tensor["dtype"]).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_weight_file(path):
+    # Returns read-only memory-mapped views, one per tensor, in file order
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a weight file" % path)
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    data_start = _align(len(MAGIC) + 8 + header_size)
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    views = []
+    for tensor in header["tensors"]:
+        start = data_start + tensor["offset"]
+        view = buffer[start : start + tensor["nbytes"]].view(np.dtype(tensor["dtype"]))
+        views.append(view.reshape(tensor["shape"]))
+    return header["tensors"], views
+
+
+def load_weight_file(model, path):
+    tensors, views = read_weight_file(path)
+    if len(views) != len(model.weights):
+        raise ValueError(
+            "%s holds %d weights, the model has %d" % (path, len(views), len(model.weights))
+        )
+    for weight, tensor in zip(model.weights, tensors):
+        if list(weight.shape) != tensor["shape"]:
+            raise ValueError(
+                "Shape mismatch for %s in %s: %s vs %s"
+                % (weight.name, path, tensor["shape"], list(weight.shape))
+            )
+    model.set_weights(views)
+
+
+def save_native_weights(models, directory, dtype=None):
+    # `models` is (text_encoder, diffusion_model, decoder, encoder)
+    os.makedirs(directory, exist_ok=True)
+    for name, model in zip(COMPONENTS, models):
+        save_weight_file(model, os.path.join(directory, name + ".sdw"), dtype=dtype)
+
+
+def load_native_weights(models, directory, max_workers=4):
+    # Components load in parallel; reading the mapped pages and assigning
+    # the variables both release the GIL
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(load_weight_file, model, os.path.join(directory, name + ".sdw"))
+            for name, model in zip(COMPONENTS, models)
+        ]
+        for future in futures:
+            future.result()
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from stable_diffusion_tf.autoencoder_kl import AttentionBlock
+from stable_diffusion_tf.layers import attention_chunk_sizes, chunked_attention
+
+
+def full_attention(q, k, v, scale):
+    score = np.einsum("bhqd,bhkd->bhqk", q, k) * scale
+    weights = np.exp(score - score.max(axis=-1, keepdims=True))
+    weights /= weights.sum(axis=-1, keepdims=True)
+    return np.einsum("bhqk,bhkd->bhqd", weights, v)
+
+
+def random_qkv(q_len, k_len, heads=2, d=8, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        rng.standard_normal((3, heads, n, d)).astype("float32") * 2
+        for n in (q_len, k_len, k_len)
+    ]
+
+
+@pytest.mark.parametrize(
+    "q_len, k_len, memory_budget",
+    [
+        (300, 16, 2 * 4 * 16 * 260),  # query chunks only, ragged last chunk
+        (50, 40, 2 * 4 * 10 * 40),  # query and key chunks, ragged on both
+        (64, 64, 2 * 4 * 16 * 16),  # query and key chunks that divide evenly
+        (20, 20, 2**20),  # fits in a single block
+    ],
+)
+def test_chunked_attention_matches_full_attention(q_len, k_len, memory_budget):
+    q, k, v = random_qkv(q_len, k_len)
+    expected = full_attention(q, k, v, 8**-0.5)
+    out = chunked_attention(tf.constant(q), tf.constant(k), tf.constant(v), 8**-0.5, memory_budget)
+    np.testing.assert_allclose(out.numpy(), expected, rtol=1e-4, atol=1e-5)
+
+    graph_fn = tf.function(lambda q, k, v: chunked_attention(q, k, v, 8**-0.5, memory_budget))
+    out = graph_fn(tf.constant(q), tf.constant(k), tf.constant(v))
+    np.testing.assert_allclose(out.numpy(), expected, rtol=1e-4, atol=1e-5)
+
+
+def test_chunks_run_in_a_sequential_loop():
+    q, k, v = random_qkv(50, 40)
+    graph_fn = tf.function(lambda q, k, v: chunked_attention(q, k, v, 1.0, 2 * 4 * 10 * 40))
+    graph = graph_fn.get_concrete_function(q, k, v).graph
+    loops = [op for op in graph.get_operations() if op.type in ("While", "StatelessWhile")]
+    assert loops
+    assert all(op.get_attr("parallel_iterations") == 1 for op in loops)
+
+
+def test_chunk_sizes_fit_the_budget():
+    q_chunk, k_chunk = attention_chunk_sizes(4096, 4096, 8, 2, 2**20)
+    assert q_chunk * k_chunk * 8 * 2 <= 2**20
+
+
+def test_vae_attention_block_chunks_match_full_attention():
+    block = AttentionBlock(32)
+    x = tf.constant(np.random.default_rng(0).standard_normal((2, 20, 15, 32)), "float32")
+    block.memory_budget = None
+    expected = block(x).numpy()
+    block.memory_budget = 4 * 300 * 260  # query chunks only
+    np.testing.assert_allclose(block(x).numpy(), expected, rtol=1e-4, atol=1e-5)
+    block.memory_budget = 4 * 20 * 20  # query and key chunks
+    np.testing.assert_allclose(block(x).numpy(), expected, rtol=1e-4, atol=1e-5)
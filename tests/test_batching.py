@@ -0,0 +1,82 @@
+import numpy as np
+import tensorflow as tf
+
+from stable_diffusion_tf.batching import BatchingEngine, ContinuousBatchingEngine
+from stable_diffusion_tf.schedulers import DPMSolverMultistepScheduler
+
+
+class StubGenerator:
+    # Just enough of StableDiffusion for the engines: the "image" of a
+    # request is its final latent, and the model predicts 0.1 * latent
+    def __init__(self, on_step=None):
+        self.generate_calls = []
+        self.step_batch_sizes = []
+        self.on_step = on_step
+
+    def generate(self, prompt, negative_prompt, num_steps, unconditional_guidance_scale, seeds, scheduler):
+        self.generate_calls.append((list(prompt), num_steps, scheduler))
+        return [np.full((2, 2, 3), seed) for seed in seeds]
+
+    def tokenize(self, prompt, name="Prompt"):
+        return [len(prompt)] * 77
+
+    def encode_text(self, tokens):
+        return np.zeros((len(tokens), 77, 8), "float32")
+
+    def get_starting_latent(self, scheduler, seeds):
+        return tf.constant(np.full((len(seeds), 2, 2, 4), seeds[0], "float32"))
+
+    def get_model_output(self, latent, t, context, unconditional_context, scale, batch_size):
+        assert len(t) == batch_size == len(latent)
+        self.step_batch_sizes.append(batch_size)
+        if self.on_step is not None:
+            self.on_step(len(self.step_batch_sizes))
+        return 0.1 * np.asarray(latent)
+
+    def decode_latent(self, latent):
+        return np.asarray(latent)
+
+
+def test_batching_engine_coalesces_compatible_requests():
+    generator = StubGenerator()
+    engine = BatchingEngine(generator, max_batch_size=4, max_wait=0.5)
+    futures = [engine.submit("a", seed=seed, num_steps=10) for seed in (1, 2, 3)]
+    other = engine.submit("b", seed=4, num_steps=20)
+    assert [f.result(timeout=10)[0, 0, 0] for f in futures] == [1, 2, 3]
+    assert other.result(timeout=10)[0, 0, 0] == 4
+    engine.close()
+    assert sorted((len(prompts), steps) for prompts, steps, _ in generator.generate_calls) == [
+        (1, 20),
+        (3, 10),
+    ]
+
+
+def run_alone(num_steps, seed):
+    generator = StubGenerator()
+    engine = ContinuousBatchingEngine(generator)
+    image = engine.submit("a", num_steps=num_steps, seed=seed, scheduler="dpm++").result(timeout=10)
+    engine.close()
+    return image
+
+
+def test_continuous_batching_join_and_leave_with_a_shared_scheduler():
+    # One scheduler instance for both requests; each sequence must get its
+    # own copy or the second request's set_timesteps resets the first
+    scheduler = DPMSolverMultistepScheduler()
+    joined = {}
+
+    def on_step(step):
+        if step == 1:
+            joined["future"] = engine.submit("b", num_steps=2, seed=2, scheduler=scheduler)
+
+    generator = StubGenerator(on_step=on_step)
+    engine = ContinuousBatchingEngine(generator, max_batch_size=4)
+    first = engine.submit("a", num_steps=5, seed=1, scheduler=scheduler)
+    first_image = first.result(timeout=10)
+    second_image = joined["future"].result(timeout=10)
+    engine.close()
+
+    # b joins after a's first step and leaves after its own two
+    assert generator.step_batch_sizes == [1, 2, 2, 1, 1]
+    np.testing.assert_allclose(first_image, run_alone(5, 1), rtol=1e-6)
+    np.testing.assert_allclose(second_image, run_alone(2, 2), rtol=1e-6)
@@ -0,0 +1,128 @@
+import os
+import pickle
+import struct
+import sys
+import types
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from stable_diffusion_tf.ckpt_loader import _Placeholder, load_state_dict
+
+
+class _Storage:
+    def __init__(self, key, storage_type, data):
+        self.key = key
+        self.storage_type = storage_type
+        self.data = data
+
+
+class _Tensor:
+    def __init__(self, storage, offset, shape, stride):
+        self.args = (storage, offset, shape, stride)
+
+    def __reduce__(self):
+        return (_Tensor.rebuild, self.args + (False, OrderedDict()))
+
+
+class _RunsCode:
+    def __reduce__(self):
+        return (os.getcwd, ())
+
+
+class _Pickler(pickle.Pickler):
+    # Writes storages as persistent ids the way torch.save does
+    def persistent_id(self, obj):
+        if isinstance(obj, _Storage):
+            return ("storage", obj.storage_type, obj.key, "cpu", obj.data.size)
+        return None
+
+
+@pytest.fixture
+def fake_torch(monkeypatch):
+    # Module globals named like torch's, so the pickle references them
+    torch = types.ModuleType("torch")
+    utils = types.ModuleType("torch._utils")
+
+    def _rebuild_tensor_v2(*args):
+        raise AssertionError("never called while pickling")
+
+    _rebuild_tensor_v2.__module__ = "torch._utils"
+    _rebuild_tensor_v2.__qualname__ = "_rebuild_tensor_v2"
+    utils._rebuild_tensor_v2 = _rebuild_tensor_v2
+    for name in ("FloatStorage", "HalfStorage", "BFloat16Storage"):
+        setattr(torch, name, type(name, (), {"__module__": "torch"}))
+    torch._utils = utils
+    monkeypatch.setitem(sys.modules, "torch", torch)
+    monkeypatch.setitem(sys.modules, "torch._utils", utils)
+    monkeypatch.setattr(_Tensor, "rebuild", _rebuild_tensor_v2, raising=False)
+    return torch
+
+
+def save_checkpoint(path, checkpoint, storages, compress_type):
+    with zipfile.ZipFile(path, "w") as archive:
+        with archive.open("archive/data.pkl", "w") as f:
+            _Pickler(f, protocol=2).dump(checkpoint)
+        for storage in storages:
+            info = zipfile.ZipInfo("archive/data/" + storage.key)
+            info.compress_type = compress_type
+            # Padding like torch's alignment, so data does not follow the name
+            info.extra = struct.pack("<HH", 0x1234, 7) + b"\0" * 7
+            archive.writestr(info, storage.data.tobytes())
+
+
+@pytest.mark.parametrize("compress_type", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_loads_tensors_and_strided_views(tmp_path, fake_torch, compress_type):
+    values = np.arange(12, dtype=np.float32)
+    storage = _Storage("0", fake_torch.FloatStorage, values)
+    half = _Storage("1", fake_torch.HalfStorage, np.array([0.5, -1.0, 2.0], np.float16))
+    checkpoint = {
+        "state_dict": OrderedDict(
+            [
+                ("plain", _Tensor(storage, 0, (3, 4), (4, 1))),
+                ("transposed", _Tensor(storage, 0, (4, 3), (1, 4))),
+                ("offset", _Tensor(storage, 5, (2, 3), (3, 1))),
+                ("half", _Tensor(half, 0, (3,), (1,))),
+            ]
+        ),
+        "callbacks": _RunsCode(),
+    }
+    path = str(tmp_path / "model.ckpt")
+    save_checkpoint(path, checkpoint, [storage, half], compress_type)
+
+    state_dict = load_state_dict(path)
+    np.testing.assert_array_equal(state_dict["plain"].numpy(), values.reshape(3, 4))
+    np.testing.assert_array_equal(state_dict["transposed"].numpy(), values.reshape(3, 4).T)
+    np.testing.assert_array_equal(state_dict["offset"].numpy(), values[5:11].reshape(2, 3))
+    assert state_dict["half"].numpy().dtype == np.float16
+    np.testing.assert_array_equal(state_dict["half"].numpy(), [0.5, -1.0, 2.0])
+
+
+def test_unknown_globals_become_placeholders(tmp_path, fake_torch):
+    path = str(tmp_path / "model.ckpt")
+    save_checkpoint(path, {"hook": _RunsCode(), "step": 3}, [], zipfile.ZIP_STORED)
+    checkpoint = load_state_dict(path)
+    assert isinstance(checkpoint["hook"], _Placeholder)
+    assert checkpoint["step"] == 3
+
+
+def test_bfloat16_storage_is_widened_to_float32(tmp_path, fake_torch):
+    expected = np.array([1.5, -2.0, 0.15625, 2.0**100], np.float32)
+    bits = (expected.view(np.uint32) >> 16).astype(np.uint16)
+    storage = _Storage("0", fake_torch.BFloat16Storage, bits)
+    path = str(tmp_path / "model.ckpt")
+    save_checkpoint(
+        path, {"w": _Tensor(storage, 0, (2, 2), (2, 1))}, [storage], zipfile.ZIP_STORED
+    )
+    weight = load_state_dict(path)["w"].numpy()
+    assert weight.dtype == np.float32
+    np.testing.assert_array_equal(weight, expected.reshape(2, 2))
+
+
+def test_rejects_legacy_checkpoints(tmp_path):
+    path = tmp_path / "legacy.ckpt"
+    path.write_bytes(pickle.dumps({"state_dict": {}}))
+    with pytest.raises(ValueError):
+        load_state_dict(str(path))
@@ -0,0 +1,46 @@
+import pytest
+
+from stable_diffusion_tf import compile_cache
+from stable_diffusion_tf.compile_cache import CompilationCache
+
+
+def flag(directory):
+    return "--tf_xla_persistent_cache_directory=%s" % directory
+
+
+def test_disabled_without_the_flag(tmp_path, monkeypatch):
+    monkeypatch.setattr(compile_cache, "_XLA_FLAGS_AT_IMPORT", "")
+    monkeypatch.delenv("TF_XLA_FLAGS", raising=False)
+    cache = CompilationCache(str(tmp_path))
+    assert not cache.enable()
+    assert cache.stats()["misses"] is None
+
+
+def test_flag_set_after_import_is_detected(tmp_path, monkeypatch):
+    monkeypatch.setattr(compile_cache, "_XLA_FLAGS_AT_IMPORT", "")
+    monkeypatch.setenv("TF_XLA_FLAGS", flag(tmp_path))
+    cache = CompilationCache(str(tmp_path))
+    assert not cache.enable()
+    assert not cache.enabled
+
+
+def test_flag_for_another_directory_is_not_used(tmp_path, monkeypatch):
+    other = flag(tmp_path / "other")
+    monkeypatch.setattr(compile_cache, "_XLA_FLAGS_AT_IMPORT", other)
+    monkeypatch.setenv("TF_XLA_FLAGS", other)
+    assert not CompilationCache(str(tmp_path)).enable()
+
+
+def test_enabled_when_set_before_import(tmp_path, monkeypatch):
+    monkeypatch.setattr(compile_cache, "_XLA_FLAGS_AT_IMPORT", flag(tmp_path))
+    monkeypatch.setenv("TF_XLA_FLAGS", flag(tmp_path))
+    gpus = []
+    monkeypatch.setattr(compile_cache.tf.config, "list_physical_devices", lambda kind: gpus)
+    with pytest.raises(RuntimeError):
+        CompilationCache(str(tmp_path)).enable()
+
+    gpus.append("GPU:0")
+    cache = CompilationCache(str(tmp_path))
+    assert cache.enable()
+    (tmp_path / "executable").write_bytes(b"")
+    assert cache.stats()["misses"] == 1
@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow import keras
+
+from stable_diffusion_tf.diffusion_model import ResBlock
+from stable_diffusion_tf.schedulers import DDIMScheduler
+from stable_diffusion_tf.stable_diffusion import StableDiffusion
+
+
+def stub_unet():
+    # Conditions on the timestep through a real ResBlock, whose broadcast of
+    # the embedding is what used to lose the static batch size
+    latent = keras.Input((8, 8, 4))
+    t_emb = keras.Input((320,))
+    context = keras.Input((3, 8))
+    h = keras.layers.Conv2D(32, 1)(latent)
+    h = ResBlock(32, 32)([h, keras.layers.Dense(32)(t_emb)])
+    ctx = keras.layers.Dense(4)(keras.layers.GlobalAveragePooling1D()(context))
+    output = keras.layers.Add()([keras.layers.Conv2D(4, 1)(h), ctx[:, None, None]])
+    return keras.Model([latent, t_emb, context], output)
+
+
+def stub_generator(batch_guidance):
+    generator = StableDiffusion.__new__(StableDiffusion)
+    generator.__dict__.update(
+        dtype=tf.float32,
+        batch_guidance=batch_guidance,
+        jit_compile=False,
+        diffusion_model=stub_unet(),
+        _sampling_loop=None,
+        _batch_buckets={},
+        _input_signatures={},
+        _compile_counts={},
+    )
+    return generator
+
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+@pytest.mark.parametrize("batch_guidance", [True, False])
+def test_graph_sampling_matches_python_loop(batch_size, batch_guidance):
+    generator = stub_generator(batch_guidance)
+    scheduler = DDIMScheduler()
+    scheduler.set_timesteps(5)
+    rng = np.random.default_rng(0)
+    latent = rng.standard_normal((batch_size, 8, 8, 4)).astype("float32")
+    context = rng.standard_normal((batch_size, 3, 8)).astype("float32")
+    unconditional_context = rng.standard_normal((batch_size, 3, 8)).astype("float32")
+    scale = np.full((batch_size, 1, 1, 1), 7.5, "float32")
+    # Guidance skipped on part of the run, as with guidance_interval
+    guided_steps = np.array([False, False, True, True, True])
+
+    state = SimpleNamespace(
+        batch_size=batch_size,
+        context=context,
+        unconditional_context=unconditional_context,
+        unconditional_guidance_scale=scale,
+        scheduler=scheduler,
+        timesteps=scheduler.timesteps,
+        latent=tf.constant(latent),
+        input_latent=None,
+        latent_mask=None,
+        guided_steps=guided_steps,
+        adaptive_guidance_threshold=None,
+        deep_cache=None,
+    )
+    for step in generator._denoise(state):
+        expected = step.latent
+
+    output = generator.sample_in_graph(
+        latent,
+        scheduler.timesteps,
+        scheduler.alphas,
+        scheduler.alphas_prev,
+        context,
+        unconditional_context,
+        scale,
+        guided_steps=guided_steps,
+    )
+    np.testing.assert_allclose(output.numpy(), np.asarray(expected), rtol=1e-4, atol=1e-4)
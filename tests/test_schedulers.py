@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from stable_diffusion_tf.schedulers import _ALPHAS, SCHEDULERS, get_scheduler
+
+# Data distributed as N(0, DATA_STD^2) has an exact noise predictor, and its
+# probability flow ODE scales samples by the ratio of marginal stds
+DATA_STD = 0.5
+
+
+def exact_e_t(latent, a_t):
+    return np.sqrt(1 - a_t) * latent / (a_t * DATA_STD**2 + 1 - a_t)
+
+
+def marginal_std(a_t):
+    return np.sqrt(a_t * DATA_STD**2 + 1 - a_t)
+
+
+def fixed_grid(num_steps):
+    # Same endpoints for every step count, so errors can be compared
+    timesteps = np.linspace(100, 999, num_steps + 1)
+    return timesteps, np.interp(timesteps, np.arange(len(_ALPHAS)), _ALPHAS)
+
+
+def sampling_error(name, num_steps, grid=None, last_index=0):
+    # Runs the steps down to `last_index` and compares with the exact ODE
+    # solution at the noise level they land on
+    scheduler = get_scheduler(name)
+    if grid is not None:
+        scheduler.get_schedule = grid
+    scheduler.set_timesteps(num_steps)
+    start = np.linspace(-2, 2, 9)
+    latent = start
+    for index in reversed(range(last_index, len(scheduler.timesteps))):
+        e_t = exact_e_t(latent, scheduler.alphas[index])
+        latent, _ = scheduler.step(latent, e_t, index)
+    a_end = scheduler.alphas_prev[last_index]
+    expected = start * marginal_std(a_end) / marginal_std(scheduler.alphas[-1])
+    return np.max(np.abs(latent - expected))
+
+
+@pytest.mark.parametrize("name", sorted(SCHEDULERS))
+def test_sampler_reaches_clean_sample(name):
+    assert sampling_error(name, 50) < 0.06
+
+
+@pytest.mark.parametrize("name", sorted(SCHEDULERS))
+def test_sampler_converges(name):
+    ratio = sampling_error(name, 20, fixed_grid, 1) / sampling_error(name, 40, fixed_grid, 1)
+    assert ratio > 1.8
+
+
+@pytest.mark.parametrize("name", ["lms", "dpm++", "unipc"])
+def test_multistep_samplers_are_higher_order(name):
+    ratio = sampling_error(name, 20, fixed_grid, 1) / sampling_error(name, 40, fixed_grid, 1)
+    assert ratio > 3
+
+
+def test_lms_runs_a_few_steps():
+    scheduler = get_scheduler("lms")
+    scheduler.set_timesteps(5)
+    latent = np.ones(4)
+    for index in [4, 3, 2]:
+        e_t = exact_e_t(latent, scheduler.alphas[index])
+        latent, pred_x0 = scheduler.step(latent, e_t, index)
+    assert np.all(np.isfinite(latent)) and np.all(np.isfinite(pred_x0))
+
+
+@pytest.mark.parametrize("name", sorted(SCHEDULERS))
+def test_set_timesteps_resets_state(name):
+    scheduler = get_scheduler(name)
+    start = np.linspace(-1, 1, 5)
+    results = []
+    for _ in range(2):
+        scheduler.set_timesteps(10)
+        latent = start
+        for index in reversed(range(len(scheduler.timesteps))):
+            e_t = exact_e_t(latent, scheduler.alphas[index])
+            latent, _ = scheduler.step(latent, e_t, index)
+        results.append(latent)
+    np.testing.assert_allclose(results[0], results[1])
+
+
+def test_get_scheduler_rejects_unknown_names():
+    with pytest.raises(ValueError):
+        get_scheduler("heun")
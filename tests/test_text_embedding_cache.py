@@ -0,0 +1,26 @@
+import numpy as np
+
+from stable_diffusion_tf.text_embedding_cache import TextEmbeddingCache
+
+
+def test_get_survives_eviction_of_its_slot(tmp_path):
+    cache = TextEmbeddingCache(max_entries=1, cache_dir=str(tmp_path), context_shape=(2, 3))
+    cache.put([1], np.ones((2, 3)))
+    context = cache.get([1])
+    cache.put([2], np.zeros((2, 3)))
+    np.testing.assert_array_equal(context, np.ones((2, 3)))
+    assert cache.get([1]) is None
+
+
+def test_namespace_separates_entries():
+    cache = TextEmbeddingCache(context_shape=(2, 3), namespace="a")
+    cache.put([1], np.ones((2, 3)))
+    cache.namespace = "b"
+    assert cache.get([1]) is None
+
+
+def test_store_reopens_from_disk(tmp_path):
+    cache = TextEmbeddingCache(max_entries=2, cache_dir=str(tmp_path), context_shape=(2, 3))
+    cache.put([1], np.full((2, 3), 5.0))
+    reopened = TextEmbeddingCache(max_entries=2, cache_dir=str(tmp_path), context_shape=(2, 3))
+    np.testing.assert_array_equal(reopened.get([1]), np.full((2, 3), 5.0))
@@ -0,0 +1,34 @@
+import threading
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from stable_diffusion_tf.layers import GroupNormalization, set_group_norm_stats_mode
+
+
+def test_group_norm_stats_mode_is_per_thread():
+    norm = GroupNormalization(groups=2, epsilon=1e-5)
+    model = keras.Sequential([norm])
+    rng = np.random.default_rng(0)
+    reference = tf.constant(rng.standard_normal((1, 4, 4, 4)), "float32")
+    x = tf.constant(rng.standard_normal((1, 4, 4, 4)) * 3 + 1, "float32")
+    expected = model(x).numpy()
+
+    set_group_norm_stats_mode(model, "record")
+    model(reference)
+    set_group_norm_stats_mode(model, "fixed")
+    try:
+        results = {}
+        thread = threading.Thread(target=lambda: results.update(other=model(x).numpy()))
+        thread.start()
+        thread.join()
+        fixed = model(x).numpy()
+    finally:
+        set_group_norm_stats_mode(model, None)
+
+    # Another thread normalises with its own statistics
+    np.testing.assert_allclose(results["other"], expected, rtol=1e-4, atol=1e-4)
+    assert not np.allclose(fixed, expected, atol=1e-2)
+    np.testing.assert_allclose(model(x).numpy(), expected, rtol=1e-4, atol=1e-4)
+    assert norm.stats_mode is None and norm.recorded_stats is None
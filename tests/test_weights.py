@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from tensorflow import keras
+
+from stable_diffusion_tf.weights import (
+    load_native_weights,
+    load_weight_file,
+    read_weight_file,
+    save_native_weights,
+    save_weight_file,
+)
+
+
+def build_model(units=5):
+    inputs = keras.Input((3,))
+    x = keras.layers.Dense(units)(inputs)
+    x = keras.layers.BatchNormalization()(x)
+    return keras.Model(inputs, keras.layers.Dense(2)(x))
+
+
+def randomize(model, seed=0):
+    rng = np.random.default_rng(seed)
+    model.set_weights([rng.standard_normal(w.shape).astype("float32") for w in model.weights])
+
+
+def test_round_trip(tmp_path):
+    source, target = build_model(), build_model()
+    randomize(source)
+    path = str(tmp_path / "model.sdw")
+    save_weight_file(source, path)
+    load_weight_file(target, path)
+    for expected, loaded in zip(source.get_weights(), target.get_weights()):
+        np.testing.assert_array_equal(loaded, expected)
+
+
+def test_float16_round_trip(tmp_path):
+    source, target = build_model(), build_model()
+    randomize(source)
+    path = str(tmp_path / "model.sdw")
+    save_weight_file(source, path, dtype="float16")
+    tensors, _ = read_weight_file(path)
+    assert {np.dtype(t["dtype"]) for t in tensors} == {np.dtype("float16")}
+    load_weight_file(target, path)
+    for expected, loaded in zip(source.get_weights(), target.get_weights()):
+        assert loaded.dtype == np.float32
+        np.testing.assert_array_equal(loaded, expected.astype("float16").astype("float32"))
+
+
+def test_shape_mismatch(tmp_path):
+    path = str(tmp_path / "model.sdw")
+    save_weight_file(build_model(units=5), path)
+    with pytest.raises(ValueError, match="Shape mismatch"):
+        load_weight_file(build_model(units=6), path)
+
+
+def test_weight_count_mismatch(tmp_path):
+    path = str(tmp_path / "model.sdw")
+    save_weight_file(build_model(), path)
+    inputs = keras.Input((3,))
+    with pytest.raises(ValueError, match="holds"):
+        load_weight_file(keras.Model(inputs, keras.layers.Dense(2)(inputs)), path)
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "model.sdw"
+    path.write_bytes(b"not a weight file")
+    with pytest.raises(ValueError):
+        read_weight_file(str(path))
+
+
+def test_native_weights_directory(tmp_path):
+    sources = [build_model() for _ in range(4)]
+    for seed, model in enumerate(sources):
+        randomize(model, seed)
+    targets = [build_model() for _ in range(4)]
+    save_native_weights(sources, str(tmp_path))
+    load_native_weights(targets, str(tmp_path))
+    for source, target in zip(sources, targets):
+        for expected, loaded in zip(source.get_weights(), target.get_weights()):
+            np.testing.assert_array_equal(loaded, expected)
@@ -53,6 +53,14 @@ parser.add_argument(
     "--steps", type=int, default=50, help="number of ddim sampling steps"
 )
 
+parser.add_argument(
+    "--scheduler",
+    type=str,
+    default="ddim",
+    choices=["ddim", "euler", "lms", "dpm++", "unipc"],
+    help="sampler used for the denoising steps",
+)
+
 parser.add_argument(
     "--seed",
     type=int,
@@ -81,6 +89,7 @@ img = generator.generate(
     temperature=1,
     batch_size=1,
     seed=args.seed,
+    scheduler=args.scheduler,
 )
 pnginfo = PngInfo()
 pnginfo.add_text('prompt', args.prompt)